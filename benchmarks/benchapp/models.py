@@ -0,0 +1,16 @@
+from django.db import models
+
+class Category(models.Model):
+    name = models.CharField(max_length=50)
+
+    class Meta:
+        app_label = 'benchapp'
+
+class Item(models.Model):
+    category = models.ForeignKey(Category,on_delete=models.CASCADE)
+    name = models.CharField(max_length=50)
+    rank = models.IntegerField(db_index=True)
+    created = models.DateTimeField()
+
+    class Meta:
+        app_label = 'benchapp'
@@ -0,0 +1,5 @@
+from rest_framework.renderers import JSONRenderer
+
+class DataRenderer(JSONRenderer):
+    """ json renderer under a format which Memoized caches """
+    format = 'data'
@@ -0,0 +1,36 @@
+import django_filters
+
+from rest_framework import serializers
+
+from rest_framework_related.views import APIView, ListAPIView
+from rest_framework_related.filters import ListFilter, MutableDjangoFilterBackend, CountBackend
+
+from .models import Item
+
+class ItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Item
+        fields = ('id','category','name','rank','created')
+
+class ItemFilter(django_filters.FilterSet):
+    category = ListFilter(name='category',lookup_expr='in')
+
+    class Meta:
+        model = Item
+        fields = ('category',)
+
+class ItemListView(ListAPIView):
+    queryset = Item.objects.all()
+    serializer_class = ItemSerializer
+    filter_class = ItemFilter
+    filter_backends = (MutableDjangoFilterBackend,CountBackend)
+    limit = 10
+
+class MemoizedItemListView(ItemListView):
+    memoization = True
+
+def composed_view(count,memoization=False):
+    """ APIView class with `count` related item lists, each one on its own category """
+    listview = MemoizedItemListView if memoization else ItemListView
+    related_views = dict(('items%s'%index,(listview.as_data(),'category=%s'%(index+1))) for index in range(count))
+    return type(APIView)('Composed%sView'%count,(APIView,),{'related_views':related_views})
@@ -0,0 +1,186 @@
+"""
+Benchmarks of composed views, memoization and filter backends.
+
+Runs against an in-memory sqlite project with synthetic models (benchmarks.benchapp)
+and prints machine readable json results, which can be saved and compared between runs:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0,ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE','benchmarks.settings')
+
+import django
+django.setup()
+
+import rest_framework
+from django.db import connection
+from django.core.cache import cache
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from rest_framework_related.filters import ValueList, ValueListFilter, ExcludeBackend, OrderBackend, MutableDjangoFilterBackend
+from rest_framework_related.utility import SubRequest
+
+from benchmarks.benchapp.models import Category, Item
+from benchmarks.benchapp.views import ItemListView, composed_view
+
+CATEGORIES = 50
+factory = APIRequestFactory()
+
+def measure(func,repeat,warmup=1,setup=None):
+    """ timings of func in milliseconds, setup is called before each run and is not timed """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        func()
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.time()
+        func()
+        timings.append((time.time()-started)*1000)
+    timings.sort()
+    return {'runs':repeat,'min_ms':round(timings[0],3),'median_ms':round(timings[len(timings)//2],3),
+            'mean_ms':round(sum(timings)/len(timings),3),'max_ms':round(timings[-1],3)}
+
+def create_tables():
+    with connection.schema_editor() as editor:
+        editor.create_model(Category)
+        editor.create_model(Item)
+    Category.objects.bulk_create([Category(id=index+1,name='category %s'%index) for index in range(CATEGORIES)])
+
+def populate(rows):
+    """ grows Item table to `rows` rows """
+    existing = Item.objects.count()
+    now = datetime(2020,1,1)
+    batch = []
+    for index in range(existing,rows):
+        batch.append(Item(category_id=index%CATEGORIES+1,name='item %s'%index,
+                          rank=random.randint(0,rows),created=now-timedelta(minutes=index)))
+        if len(batch)==5000:
+            Item.objects.bulk_create(batch)
+            batch = []
+    Item.objects.bulk_create(batch)
+
+def drf_request(path):
+    request = Request(factory.get(path))
+    request.accepted_renderer = ItemListView.renderer_classes[0]()
+    return request
+
+def bench_fetch_related(counts,repeat):
+    results = []
+    for memoization in (False,True):
+        for count in counts:
+            view = composed_view(count,memoization).as_view()
+            def run(view=view):
+                view(factory.get('/composed/')).render()
+            results.append(dict(name='fetch_related',params={'related_views':count,'memoization':memoization},
+                                **measure(run,repeat)))
+    return results
+
+def bench_memoized(repeat):
+    view = composed_view(1,memoization=True).related_views['items0'][0]
+    request = SubRequest(drf_request('/items/'))
+    def run():
+        view(request,category='1')
+    return [
+        dict(name='memoized',params={'path':'miss'},**measure(run,repeat,setup=cache.clear)),
+        dict(name='memoized',params={'path':'hit'},**measure(run,repeat)),
+    ]
+
+def bench_backends(rows,repeat):
+    view = ItemListView()
+    view.kwargs = {}
+    view.order_by_clause = {'rank':['rank','id'],'latest':['-created']}
+    cases = [
+        ('MutableDjangoFilterBackend',MutableDjangoFilterBackend,'/items/?category=1,2,3,4,5'),
+        ('ExcludeBackend',ExcludeBackend,'/items/?excludevalue=%s'%','.join(str(index) for index in range(1,1000))),
+        ('OrderBackend',OrderBackend,'/items/?order=latest'),
+    ]
+    results = []
+    for name,backend,path in cases:
+        request = drf_request(path)
+        view.request = request
+        def run(backend=backend,request=request):
+            list(backend().filter_queryset(request,Item.objects.all(),view)[:100])
+        results.append(dict(name=name,params={'rows':rows},**measure(run,repeat)))
+    return results
+
+def bench_value_list(sizes,repeat):
+    results = []
+    valuefilter = ValueListFilter(name='category')
+    for size in sizes:
+        value_list = [{'id':index,'category':index%CATEGORIES+1} for index in range(size)]
+        def run(value_list=value_list):
+            list(valuefilter.filter(value_list,'1,2,3,4,5'))
+        results.append(dict(name='ValueListFilter',params={'size':size},**measure(run,repeat)))
+        indexed = ValueList(value_list)
+        def run(value_list=indexed):
+            list(valuefilter.filter(value_list,'1,2,3,4,5'))
+        results.append(dict(name='ValueListFilter',params={'size':size,'indexed':True},**measure(run,repeat)))
+    return results
+
+def compare(results,baseline):
+    """ prints median ratios of results against a previous run """
+    previous = dict(((each['name'],json.dumps(each['params'],sort_keys=True)),each) for each in baseline['results'])
+    for each in results:
+        before = previous.get((each['name'],json.dumps(each['params'],sort_keys=True)))
+        if before and before['median_ms']:
+            sys.stderr.write('%-28s %-45s %8.3fms -> %8.3fms  x%.2f\n' %(each['name'],json.dumps(each['params'],sort_keys=True),
+                before['median_ms'],each['median_ms'],each['median_ms']/before['median_ms']))
+
+def parse_sizes(value):
+    return [int(each) for each in value.split(',') if each]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows',type=parse_sizes,default=[10000,100000],help='table sizes for filter backends, up to 1000000')
+    parser.add_argument('--related',type=parse_sizes,default=[1,5,10,25,50],help='related view counts for fetch_related')
+    parser.add_argument('--values',type=parse_sizes,default=[10000,100000],help='value list sizes for ValueListFilter')
+    parser.add_argument('--repeat',type=int,default=20)
+    parser.add_argument('--output',help='file to write the json results to, stdout by default')
+    parser.add_argument('--compare',help='json results of a previous run to compare with')
+    args = parser.parse_args()
+
+    random.seed(0)
+    create_tables()
+    results = []
+    populate(min(args.rows))
+    results += bench_fetch_related(args.related,args.repeat)
+    results += bench_memoized(args.repeat)
+    for rows in sorted(args.rows):
+        populate(rows)
+        results += bench_backends(rows,args.repeat)
+    results += bench_value_list(args.values,args.repeat)
+
+    report = {
+        'meta':{'python':platform.python_version(),'django':django.get_version(),
+                'djangorestframework':rest_framework.VERSION,'time':datetime.utcnow().isoformat()},
+        'results':results,
+    }
+    output = json.dumps(report,indent=2)
+    if args.output:
+        with open(args.output,'w') as outfile:
+            outfile.write(output)
+    else:
+        sys.stdout.write(output+'\n')
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(results,json.load(infile))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+""" Django settings of the benchmark project, an in-memory sqlite database and locmem cache """
+SECRET_KEY = 'benchmarks'
+DEBUG = False
+#host of APIRequestFactory requests, which related views read through build_absolute_uri
+ALLOWED_HOSTS = ['testserver']
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'rest_framework',
+    'benchmarks.benchapp',
+]
+DATABASES = {
+    'default': {'ENGINE':'django.db.backends.sqlite3','NAME':':memory:'},
+}
+CACHES = {
+    'default': {'BACKEND':'django.core.cache.backends.locmem.LocMemCache','OPTIONS':{'MAX_ENTRIES':100000}},
+}
+ROOT_URLCONF = 'benchmarks.settings'
+urlpatterns = []
+USE_TZ = False
+SITE_ID = 1
+MEMOIZE_DURATION = 300
+REST_FRAMEWORK = {
+    #Memoized does not cache api and json formats, see Memoized.excluded_renderer
+    'DEFAULT_RENDERER_CLASSES': ('benchmarks.benchapp.renderers.DataRenderer',),
+    'DEFAULT_AUTHENTICATION_CLASSES': (),
+    'DEFAULT_PERMISSION_CLASSES': (),
+    'UNAUTHENTICATED_USER': None,
+}
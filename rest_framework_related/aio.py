@@ -0,0 +1,247 @@
+"""
+asyncio support for related views (python 3.5+ only, hence kept out of mixins and views).
+
+Views from this module can be served under ASGI with as_async_view. A view defining a coroutine
+handler (`aget` for GET) is dispatched on the event loop, see AsyncRelatedView.adispatch. Other
+views run in an executor thread because the ORM is synchronous. Related views are gathered on the
+event loop: handlers which are coroutine functions (e.g as_async_data of a view defining `aget`)
+are awaited directly and the rest are run in executor threads.
+Streamed responses (ListAPIView.stream_response) fetch their related views while the body is
+iterated, in the thread serving the synchronous iterator, not on the event loop.
+"""
+import asyncio
+
+from django.db import connections
+
+from rest_framework.response import Response
+
+from . import views
+from .utility import Memoized
+
+def run_sync(func,*args,**kwargs):
+    """ run a blocking function in the default executor, closing connections opened by it """
+    def call():
+        try:
+            return func(*args,**kwargs)
+        finally:
+            connections.close_all()
+    return get_running_loop().run_in_executor(None,call)
+
+def get_running_loop():
+    #asyncio.get_running_loop is python 3.7+
+    return getattr(asyncio,'get_running_loop',asyncio.get_event_loop)()
+
+def has_related(view,reqviews,predicate):
+    """ whether predicate holds for the callback of any of the requested related views """
+    for name in reqviews:
+        relobj = view.related_views.get(name,None)
+        if relobj and predicate(relobj[0]):
+            return True
+    return False
+
+def is_memoized(callback):
+    return isinstance(callback,Memoized)
+
+def is_batched(callback):
+    return not isinstance(callback,Memoized) and getattr(getattr(callback,'_class',None),'batch_field',None) is not None
+
+class AsyncRelatedView(object):
+    '''Mixin for RelatedView subclasses which makes them callable and servable from asyncio.'''
+
+    @classmethod
+    def as_async_data(cls,**initkwargs):
+        """
+        Coroutine function counterpart of as_data. If the view defines a coroutine method
+        `aget` it is awaited, otherwise the (possibly memoized) as_data view runs in an executor.
+        """
+        if getattr(cls,'aget',None) is None:
+            data_view = cls.as_data(**initkwargs)
+            async def view(request,*args,**kwargs):
+                return await run_sync(data_view,request,*args,**kwargs)
+        else:
+            async def view(request,*args,**kwargs):
+                self=cls(**initkwargs)
+                self.retType = 'data'
+                self.request = request
+                self.format_kwarg = None
+                self.args = args
+                self.kwargs = kwargs
+                try:
+                    resp = await self.aget(request,*args,**kwargs)
+                finally:
+                    self.finalize_data(request)
+                if isinstance(resp,Response):resp = resp.data
+                return resp
+
+        setattr(view,'__name__',cls.__name__)
+        setattr(view,'_class',cls)
+        setattr(view,'_initkwargs',initkwargs)
+        return view
+
+    #authentication, permissions and throttles of the view do not use the ORM, see adispatch
+    initial_on_loop = False
+
+    @classmethod
+    def as_async_view(cls,**initkwargs):
+        """
+        ASGI compatible view. Methods with a coroutine handler are dispatched on the event loop
+        by adispatch. The others are dispatched as usual in an executor thread with deferred_related
+        set, so that the related views are fetched afterwards by afetch_related on the event loop.
+        """
+        initkwargs['deferred_related'] = True
+        sync_view = cls.as_view(**initkwargs)
+
+        async def view(request,*args,**kwargs):
+            method = request.method.lower()
+            if method in cls.http_method_names and asyncio.iscoroutinefunction(getattr(cls,'a%s'%method,None)):
+                return await cls(**initkwargs).adispatch(request,*args,**kwargs)
+            response = await run_sync(sync_view,request,*args,**kwargs)
+            deferred = getattr(response,'deferred_related',None)
+            if deferred is None:
+                return response
+            self,drf_request = deferred
+            del response.deferred_related
+            try:
+                response = await self.afetch_related(drf_request,response)
+            except Exception as exc:
+                response = self.handle_exception(exc)
+            if isinstance(response,Response) and getattr(response,'accepted_renderer',None) is None:
+                response = self.finalize_response(drf_request,response,*args,**kwargs)
+            return response
+
+        view.csrf_exempt = True
+        setattr(view,'__name__',cls.__name__)
+        setattr(view,'cls',cls)
+        setattr(view,'initkwargs',initkwargs)
+        return view
+
+    async def adispatch(self,request,*args,**kwargs):
+        """
+        Coroutine counterpart of dispatch for methods with a coroutine handler, e.g aget returning
+        `await self.afetch_related(request,response)` as get returns fetch_related. No thread is taken
+        for the request when initial_on_loop is set, otherwise initial runs in an executor thread.
+        """
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request,*args,**kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            if self.initial_on_loop:
+                self.initial(request,*args,**kwargs)
+            else:
+                await run_sync(self.initial,request,*args,**kwargs)
+            handler = getattr(self,'a%s'%request.method.lower())
+            response = await handler(request,*args,**kwargs)
+            deferred = getattr(response,'deferred_related',None)
+            if deferred is not None:
+                #the handler returned fetch_related of the main view instead of afetch_related
+                del response.deferred_related
+                response = await self.afetch_related(request,response)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request,response,*args,**kwargs)
+        return self.response
+
+    async def afetch_related(self,request,response,*args,**kwargs):
+        ''' coroutine counterpart of fetch_related which gathers the related views '''
+        relateddata = {}
+        main = self.get_page_main(response)
+        reqviews = self.prepare_related(request,response)
+        if reqviews is None:
+            await self.astore_page_fragments(main,(),response.data,relateddata)
+            response = self.get_final_response(request,response)
+            self.set_etag(response)
+            return self.report_related_metrics(request,response)
+        pending = []
+        if reqviews:
+            pending = self.splice_page_fragments(reqviews,response.data,relateddata)
+            self.start_related_deadline()
+            #executor threads only when there is blocking work to do
+            batch = None
+            if has_related(self,pending,is_memoized):
+                batch = await run_sync(self.prefetch_memoized,pending,request)
+            if has_related(self,pending,is_batched):
+                await run_sync(self.prime_related_loader,pending,request)
+            await self.gather_related(pending,request,response.data,relateddata,batch)
+            if batch is not None:
+                await run_sync(batch.flush)
+            response.data['extdata']=relateddata
+            self.mark_partial_related(response.data)
+        await self.astore_page_fragments(main,pending,response.data,relateddata)
+        return self.finalize_related(request,response)
+
+    async def astore_page_fragments(self,main,names,responsedata,relateddata):
+        """ store_page_fragments in an executor thread, the cache backend may block """
+        if getattr(self,'_page_key',None) and (main is not None or names):
+            await run_sync(self.store_page_fragments,main,names,responsedata,relateddata)
+
+    async def acall_related_view(self,relobj,request):
+        if len(relobj)<1:
+            raise Exception('Related View must have a handler function')
+        callback = relobj[0]
+        if asyncio.iscoroutinefunction(callback):
+            metrics = self.get_related_metrics()
+            if metrics is None:
+                resp = await callback(request,**request.query_params)
+            else:
+                #queries of other views running meanwhile may be counted too
+                with metrics.measure(request.related_name) as status:
+                    resp = await callback(request,**request.query_params)
+                    status['cache'] = getattr(request,'memo_status',None)
+            return self.clean_related_response(resp)
+        return await run_sync(self.call_related_view,relobj,request)
+
+    async def gather_related(self,reqviews,request,responsedata,relateddata,batch=None):
+        """
+        Runs the related views concurrently on the event loop, honouring related_dependencies
+        and merging responses in the order of reqviews as fetch_related_concurrent does.
+        """
+        loop = get_running_loop()
+        order = list(reqviews)
+        pending = list(range(len(order)))
+        tasks = {}
+        merged = 0
+        try:
+            while merged < len(order):
+                for index in self.pop_ready_related(order,pending,merged):
+                    name = order[index]
+                    self.set_pipelined_response(name,request,responsedata)
+                    relobj = self.related_views.get(name,None)
+                    if relobj:
+                        dummyreq = self.get_related_request(request,relobj,name,batch)
+                        timeout = self.get_related_timeout(name)
+                        task = None if timeout==0 else asyncio.ensure_future(self.acall_related_view(relobj,dummyreq))
+                        deadline = None if timeout is None else loop.time()+timeout
+                        tasks[index] = (relobj,dummyreq,task,deadline)
+                if merged in tasks:
+                    name = order[merged]
+                    relobj,dummyreq,task,deadline = tasks.pop(merged)
+                    if task is None:
+                        resp = self.degrade_related(name,relobj,dummyreq,'time budget exhausted')
+                    else:
+                        try:
+                            resp = await asyncio.wait_for(task,None if deadline is None else max(0,deadline-loop.time()))
+                        except asyncio.TimeoutError:
+                            resp = self.degrade_related(name,relobj,dummyreq,'timed out')
+                        except Exception as exc:
+                            resp = self.degrade_related(name,relobj,dummyreq,exc)
+                    if resp is not None:
+                        self.merge_related_response(name,relobj,resp,responsedata,relateddata)
+                merged += 1
+        finally:
+            for relobj,dummyreq,task,deadline in tasks.values():
+                if task is not None:
+                    task.cancel()
+
+class APIView(AsyncRelatedView,views.APIView):
+    pass
+
+class JSONAPIView(AsyncRelatedView,views.JSONAPIView):
+    pass
+
+class ListAPIView(AsyncRelatedView,views.ListAPIView):
+    pass
+
+class RetrieveAPIView(AsyncRelatedView,views.RetrieveAPIView):
+    pass
@@ -0,0 +1,170 @@
+import copy
+import logging
+import threading
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
+
+from .views import APIView
+from .utility import SubRequest, cache_value
+from .py2_3 import *
+
+logger = logging.getLogger(__name__)
+
+class RelatedRegistry(object):
+    """
+    Data of the views called within a batch, by (callback,params), so that a related view shared
+    by several composed views runs once. A caller asking for data being computed by another thread
+    waits for it. Every caller gets its own copy of the data, hits counts the calls served from it.
+    """
+    def __init__(self):
+        self.results = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def get_key(self,callback,params):
+        return (callback,tuple(sorted((key,cache_value(value)) for key,value in params.items())))
+
+    def call(self,callback,params,func):
+        key = self.get_key(callback,params)
+        with self._lock:
+            if key in self.results:
+                self.hits += 1
+                return copy.deepcopy(self.results[key])
+            event = self._pending.get(key)
+            owner = event is None
+            if owner:
+                event = self._pending[key] = threading.Event()
+        if not owner:
+            event.wait()
+            with self._lock:
+                if key in self.results:
+                    self.hits += 1
+                    return copy.deepcopy(self.results[key])
+            #the owner failed, try here
+            return func()
+        try:
+            data = func()
+            with self._lock:
+                self.results[key] = copy.deepcopy(data)
+            return data
+        finally:
+            with self._lock:
+                self._pending.pop(key,None)
+            event.set()
+
+class BatchView(APIView):
+    """
+    Runs several views in one request, POST {"views":[{"name":"feed","params":{"page":"2"},"key":"feed2"},..]}
+    where name is a key of batch_views, a dict of view functions (e.g FeedView.as_data()), and key
+    (default name) the member of the response holding the data of the view. The views and their
+    related views share a RelatedRegistry, so that identical (callback,params) run once per batch.
+    Views are run concurrently like related views (concurrent_related or RELATED_VIEWS_CONCURRENT).
+    Each view is subject to its own permission_classes and throttle_classes, checked for the user
+    authenticated by the batch request as if it was requested with GET.
+    A failing view fails the batch, unless degrade_related_views is set, then its member is
+    {"error":batch_error_message}, its key is listed under related_partial_member and the error is logged.
+    """
+    batch_views = {}
+    batch_max_views = 10
+    batch_error_message = 'The view could not be served'
+    http_method_names = ['post','options']
+
+    def get_batch_entries(self,request):
+        entries = request.data.get('views') if hasattr(request.data,'get') else None
+        if not isinstance(entries,list) or not entries:
+            raise ValidationError({'views':'A list of views is required'})
+        if len(entries)>self.batch_max_views:
+            raise ValidationError({'views':'At most %s views can be batched' %self.batch_max_views})
+        parsed = OrderedDict()
+        for entry in entries:
+            if not isinstance(entry,dict) or entry.get('name') not in self.batch_views:
+                raise ValidationError({'views':'Unknown view %s' %(entry.get('name') if isinstance(entry,dict) else entry)})
+            params = entry.get('params') or {}
+            if not isinstance(params,dict):
+                raise ValidationError({'views':'params of %s must be an object' %entry['name']})
+            key = entry.get('key') or entry['name']
+            if key in parsed:
+                raise ValidationError({'views':'Duplicate key %s' %key})
+            parsed[key] = (entry['name'],dict((name,cache_value(value)) for name,value in params.items()))
+        return parsed
+
+    def get_batch_request(self,request,params,registry):
+        subrequest = SubRequest(request,params)
+        #the views are called through their get handler
+        subrequest.method = 'GET'
+        subrequest.related_registry = registry
+        return subrequest
+
+    def check_batch_view(self,callback,request):
+        """
+        Runs the permission and throttle checks of the view of callback, skipped by as_data
+        which does not call initial(). Raises PermissionDenied, NotAuthenticated or Throttled.
+        """
+        func = getattr(callback,'_func',callback)
+        viewcls = getattr(func,'_class',None)
+        if viewcls is None:
+            return
+        view = viewcls(**getattr(func,'_initkwargs',{}))
+        view.request = request
+        view.format_kwarg = None
+        view.args = ()
+        view.kwargs = dict(request.query_params.items())
+        view.check_permissions(request)
+        view.check_throttles(request)
+
+    def call_batch_view(self,name,params,request,registry):
+        callback = self.batch_views[name]
+        subrequest = self.get_batch_request(request,params,registry)
+        self.check_batch_view(callback,subrequest)
+        def call():
+            return self.clean_related_response(callback(subrequest,**subrequest.query_params))
+        return registry.call(callback,subrequest.query_params,call)
+
+    def post(self,request,*args,**kwargs):
+        entries = self.get_batch_entries(request)
+        registry = RelatedRegistry()
+        self._partial_related = []
+        calls = [(key,name,params) for key,(name,params) in entries.items()]
+        if self.is_concurrent_related() and ThreadPoolExecutor is not None and len(calls)>1:
+            max_workers = getattr(self,'related_max_workers',None) or getattr(settings,'RELATED_VIEWS_MAX_WORKERS',4)
+            executor = ThreadPoolExecutor(max_workers=max(1,min(max_workers,len(calls))))
+            try:
+                futures = [(key,executor.submit(self._call_batch_in_worker,name,params,request,registry)) for key,name,params in calls]
+                results = [(key,self._batch_result(key,future.result)) for key,future in futures]
+            finally:
+                executor.shutdown(wait=True)
+        else:
+            results = [(key,self._batch_result(key,lambda name=name,params=params:self.call_batch_view(name,params,request,registry)))
+                       for key,name,params in calls]
+        data = OrderedDict(results)
+        self.mark_partial_related(data)
+        return Response(data)
+
+    def _call_batch_in_worker(self,name,params,request,registry):
+        try:
+            return self.call_batch_view(name,params,request,registry)
+        finally:
+            connections.close_all()
+
+    def _batch_result(self,key,get):
+        try:
+            return get()
+        except Exception:
+            if not self.is_degrade_related():
+                raise
+            logger.exception('Batched view %s of %s failed',key,self.__class__.__name__)
+            self._partial_related.append(key)
+            return {'error':self.batch_error_message}
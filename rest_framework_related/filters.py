@@ -1,10 +1,10 @@
 import copy
+import threading
 import django_filters
 
 from datetime import datetime
 from django.http.request import QueryDict
-from django.core.exceptions import FieldError
-from django.db.models.fields import FieldDoesNotExist
+from django.core.exceptions import FieldError, FieldDoesNotExist
 
 try:
     from django_filters.rest_framework import DjangoFilterBackend
@@ -13,6 +13,11 @@ except ImportError:
     from rest_framework.filters import DjangoFilterBackend
 
 from .utility import cstolist, NoPagination
+from .inlist import get_in_list
+
+def get_filter_view(filter_):
+    """ view filtered by the filterset of filter_, set by MutableDjangoFilterBackend, else None """
+    return getattr(getattr(filter_,'parent',None),'view',None)
 
 class ListFilter(django_filters.Filter):
     def filter(self,qs,value):
@@ -25,6 +30,9 @@ class ListFilter(django_filters.Filter):
             # Use 'in' query only when multiple filters are to be applied on single fields otherwise direct matching'
             # For other usecases please consider this point in mind before extending
             if len(value)>1:
+                if self.lookup_expr == 'in':
+                    #long lists are applied by the strategy fitting the database
+                    return get_in_list(get_filter_view(self)).apply(qs,self.name,value,getattr(self,'exclude',False))
                 return self.get_method(qs)(**{'%s__%s'%(self.name,self.lookup_expr):value})
             else:
                 return self.get_method(qs)(**{'%s'%(self.name):value[0]})
@@ -32,6 +40,11 @@ class ListFilter(django_filters.Filter):
 
 class ValueListFilter(django_filters.Filter):
     def filter(self,value_list,value):
+        if isinstance(value_list,ValueList):
+            #validated once by ValueList, answered from its index
+            if value not in (None,'',[]):
+                value_list = value_list.filter(**{'%s__in'%self.name:cstolist(value)})
+            return value_list
         validated = all([isinstance(each,dict) for each in value_list])
         if not validated:
             raise Exception('Invalid ValuList. Value list means, list of dictionary, so simple')
@@ -41,18 +54,135 @@ class ValueListFilter(django_filters.Filter):
         return value_list
 
 class ValueList(list):
-    def __init__(self,value_list):
+    """
+    List of dictionaries (e.g data of an api) which can be used in place of a queryset.
+    Supports filter, exclude, order_by, slicing and count so that filters and backends
+    (ValueListFilter, ExcludeBackend, OrderBackend, CountBackend) work on it as on querysets.
+    Hash indexes per field are built on first use and shared by the lists derived from it,
+    so `field=value` and `field__in=values` lookups are answered by set operations.
+    """
+    scan_lookups = {
+        'iexact': lambda x,y: x is not None and y is not None and str(x).lower()==str(y).lower(),
+        'contains': lambda x,y: x is not None and y in x,
+        'icontains': lambda x,y: x is not None and str(y).lower() in str(x).lower(),
+        'gt': lambda x,y: x is not None and x>y,
+        'gte': lambda x,y: x is not None and x>=y,
+        'lt': lambda x,y: x is not None and x<y,
+        'lte': lambda x,y: x is not None and x<=y,
+        'isnull': lambda x,y: (x is None)==bool(y),
+    }
+
+    def __init__(self,value_list,_source=None,_positions=None):
+        if _source is None:
+            value_list = list(value_list)
+            if not all(isinstance(each,dict) for each in value_list):
+                raise Exception('Invalid ValuList. Value list means, list of dictionary, so simple')
+            self._rows = value_list
+            self._indexes = {}
+            self._lock = threading.Lock()
+            _positions = range(len(value_list))
+        else:
+            self._rows = _source._rows
+            self._indexes = _source._indexes
+            self._lock = _source._lock
+        self._positions = list(_positions)
+        super(ValueList,self).__init__(self._rows[position] for position in self._positions)
         self.model = self.__class__
-        self.value_list = value_list
+
+    @property
+    def value_list(self):
+        return self
 
     def all(self):
-        return self.value_list
+        return self
+
+    def _derive(self,positions):
+        return ValueList(None,_source=self,_positions=positions)
+
+    def _index(self,field):
+        index = self._indexes.get(field)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(field)
+                if index is None:
+                    index = {}
+                    for position,row in enumerate(self._rows):
+                        index.setdefault(row.get(field),set()).add(position)
+                    self._indexes[field] = index
+        return index
+
+    def _lookup(self,key,value):
+        """ positions of all rows matching a lookup e.g name, name__in, name__gt """
+        field,_,lookup = key.partition('__')
+        lookup = lookup or 'exact'
+        if lookup in ('exact','in'):
+            values = value if lookup=='in' else [value]
+            try:
+                index = self._index(field)
+                matched = set()
+                for each in values:
+                    matched.update(index.get(each,()))
+                return matched
+            except TypeError:
+                #unhashable values can not be indexed
+                return set(position for position,row in enumerate(self._rows) if (row.get(field) in values))
+        if lookup not in self.scan_lookups:
+            raise FieldError('Lookup %s is not supported by ValueList' %lookup)
+        compare = self.scan_lookups[lookup]
+        return set(position for position,row in enumerate(self._rows) if compare(row.get(field),value))
+
+    def filter(self,**kwargs):
+        positions = None
+        for key,value in kwargs.items():
+            matched = self._lookup(key,value)
+            positions = matched if positions is None else positions & matched
+        if positions is None:
+            return self._derive(self._positions)
+        return self._derive(position for position in self._positions if position in positions)
+
+    def exclude(self,**kwargs):
+        positions = None
+        for key,value in kwargs.items():
+            matched = self._lookup(key,value)
+            positions = matched if positions is None else positions & matched
+        if not positions:
+            return self._derive(self._positions)
+        return self._derive(position for position in self._positions if position not in positions)
+
+    def order_by(self,*fields):
+        positions = list(self._positions)
+        #stable sorts from the last field to the first one, None values first
+        for field in reversed(fields):
+            name = field.lstrip('-')
+            positions.sort(key=lambda position:(self._rows[position].get(name) is not None,self._rows[position].get(name)),
+                           reverse=field.startswith('-'))
+        return self._derive(positions)
+
+    def count(self,*args):
+        if args:
+            return super(ValueList,self).count(*args)
+        return len(self._positions)
+
+    def exists(self):
+        return bool(self._positions)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return self._derive(self._positions[index])
+        return self._rows[self._positions[index]]
+
+    def __getslice__(self,start,stop):
+        # python 2 only
+        return self.__getitem__(slice(start,stop))
 
     class _meta(object):
         @staticmethod
         def get_field_by_name(*args,**kwargs):
             raise FieldDoesNotExist()
-    
+
+        @staticmethod
+        def get_field(*args,**kwargs):
+            raise FieldDoesNotExist()
 
 class ExcludeListFilter(django_filters.Filter):
     def filter(self,qs,value):
@@ -66,6 +196,8 @@ class ExcludeListFilter(django_filters.Filter):
             # Use 'in' query only when multiple filters are to be applied on single fields otherwise direct matching'
             # For other usecases please consider this point in mind before extending
             if len(value)>1:
+                if self.lookup_type == 'in':
+                    return get_in_list(get_filter_view(self)).exclude(qs,self.name,value)
                 return qs.exclude(**{'%s__%s'%(self.name,self.lookup_type):value})
             else:
                 return qs.exclude(**{'%s'%(self.name):value[0]})
@@ -97,8 +229,7 @@ class ExcludeBackend(object):
         self.exclude_val = values = request.query_params.get(exclude_val)
         if values:
             values = cstolist(values)
-            exclude_kwargs = {'{0}__in'.format(key) : values}
-            return queryset.exclude(**exclude_kwargs)
+            return get_in_list(view).exclude(queryset,key,values)
         return queryset
     def get_applied_filters(self):
         return {'excluded_{0}'.format(self.exclude_key):self.exclude_val}
@@ -115,14 +246,18 @@ class OrderBackend(object):
         order_param = request.query_params.get(order_key,'default')
         order_by_tuple = self.get_ordering(order_param)
 
+        #ordering applied by this backend, read by KeysetPagination
+        view.applied_ordering = None
         if order_by_param:
             ordering = cstolist(order_by_param)
             queryset=queryset.order_by(*ordering)
+            view.applied_ordering = list(ordering)
             self._filters = {order_by_key:order_by_param}
 
         elif order_by_tuple:
             ordering = order_by_tuple
             queryset = queryset.order_by(*ordering)
+            view.applied_ordering = list(ordering)
             #@TODO Handle ordering for null fields in database
 #            if self.field_sort and not "__" in self.field_sort:
 #                field_sort = self.field_sort
@@ -143,7 +278,7 @@ class OrderBackend(object):
         order_param = order_param[1:] if desc_order else order_param
         order_by_tuple = self.order_by_clause.get(order_param,[])
         if desc_order:
-            order_by_tuple = map(negative_fn,order_by_tuple)
+            order_by_tuple = list(map(negative_fn,order_by_tuple))
         if len(order_by_tuple)==1:
             self.field_sort = positive_fn(order_by_tuple[0])
         return order_by_tuple
@@ -169,6 +304,8 @@ class MutableDjangoFilterBackend(DjangoFilterBackend):
             if view.kwargs:
                 fargs.update(view.kwargs)
             filterobj=filter_class(fargs, queryset=queryset)
+            #read by ListFilter and ExcludeListFilter for in_list_class of the view
+            filterobj.view = view
             qs= filterobj.qs
             self.applied_filters = filterobj.form.cleaned_data
             return qs
@@ -0,0 +1,124 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from .py2_3 import *
+
+class SessionFlowStore(object):
+    """
+    Request scoped state of the FormView flow: the flow of return urls, the packet passed to the
+    next form view and the cache of each form view. It is read once from a single session entry,
+    changed in memory and written back by save() at most once per request, only if it changed.
+    State kept by earlier versions under _formflow, _packet and *_form_view keys is taken over.
+    """
+    session_key = '_formflowstate'
+    legacy_keys = ('_formflow','_packet')
+    legacy_suffix = '_form_view'
+
+    def __init__(self,request):
+        self.request = request
+        self.session = request.session
+        self.modified = False
+        self._legacy = []
+        state = self.load()
+        if state is None:
+            state = self.load_legacy()
+        self.state = state or {}
+
+    def load(self):
+        return self.session.get(self.session_key)
+
+    def load_legacy(self):
+        self._legacy = [key for key in self.session.keys() if key in self.legacy_keys or key.endswith(self.legacy_suffix)]
+        if not self._legacy:
+            return None
+        self.modified = True
+        views = dict((key,self.session[key]) for key in self._legacy if key.endswith(self.legacy_suffix))
+        return self.compact({'f':self.session.get('_formflow'),'p':self.session.get('_packet'),'v':views})
+
+    def compact(self,state):
+        """ state without empty members """
+        views = dict((key,value) for key,value in (state.get('v') or {}).items() if value)
+        state = {'f':state.get('f'),'p':state.get('p'),'v':views}
+        return dict((key,value) for key,value in state.items() if value)
+
+    def write(self,state):
+        if state:
+            self.session[self.session_key] = state
+        else:
+            self.session.pop(self.session_key,None)
+
+    def save(self):
+        if not self.modified:
+            return False
+        for key in self._legacy:
+            self.session.pop(key,None)
+        self._legacy = []
+        self.write(self.compact(self.state))
+        self.modified = False
+        return True
+
+    def get_flow(self):
+        return self.state.get('f')
+
+    def set_flow(self,flow):
+        self.state['f'] = flow
+        self.modified = True
+
+    def get_packet(self):
+        return self.state.get('p')
+
+    def set_packet(self,packet):
+        self.state['p'] = packet
+        self.modified = True
+
+    def get_view_data(self,name):
+        return self.state.get('v',{}).get(name)
+
+    def set_view_data(self,name,data):
+        self.state.setdefault('v',{})[name] = data
+        self.modified = True
+
+    def clear(self):
+        if self.state:
+            self.state = {}
+            self.modified = True
+
+class CacheFlowStore(SessionFlowStore):
+    """
+    Flow state kept in django cache for cache_timeout seconds (SESSION_COOKIE_AGE by default),
+    the session only holds the id of the state, written once when the flow starts.
+    """
+    id_key = '_formflowid'
+    cache_timeout = None
+
+    def get_cache_key(self,flow_id):
+        return 'formflow:%s' %flow_id
+
+    def load(self):
+        flow_id = self.session.get(self.id_key)
+        if flow_id is None:
+            return None
+        #an expired state is an empty flow, not an older session one
+        return cache.get(self.get_cache_key(flow_id)) or {}
+
+    def write(self,state):
+        flow_id = self.session.get(self.id_key)
+        if not state:
+            if flow_id is not None:
+                cache.delete(self.get_cache_key(flow_id))
+            return
+        if flow_id is None:
+            flow_id = self.session[self.id_key] = uuid.uuid4().hex
+        timeout = self.cache_timeout or getattr(settings,'SESSION_COOKIE_AGE',None)
+        cache.set(self.get_cache_key(flow_id),state,timeout)
+        self.session.pop(self.session_key,None)
+
+def get_flow_store_class(view=None):
+    """ flow_store_class of the view, else RELATED_VIEWS_FLOW_STORE setting, else SessionFlowStore """
+    store_class = getattr(view,'flow_store_class',None) or getattr(settings,'RELATED_VIEWS_FLOW_STORE',None) or SessionFlowStore
+    if isinstance(store_class,(str,unicode)):
+        store_class = import_string(store_class)
+    return store_class
@@ -0,0 +1,136 @@
+import logging
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+
+from rest_framework.serializers import BaseSerializer, ListSerializer
+from rest_framework.relations import PrimaryKeyRelatedField
+
+from .py2_3 import *
+
+logger = logging.getLogger(__name__)
+
+#(serializer class,model) -> (select_related paths,prefetch_related paths)
+_inferred_relations = {}
+
+def get_relation(model,name):
+    """ (related model,is to one relation,is forward relation) of a relation attribute of model or None """
+    opts = model._meta
+    try:
+        field = opts.get_field(name)
+    except FieldDoesNotExist:
+        field = None
+    if field is not None and not field.auto_created:
+        if not field.is_relation or field.related_model is None:
+            return None
+        return field.related_model,bool(field.many_to_one or field.one_to_one),True
+    #reverse relations are reached by their accessor name
+    for rel in opts.related_objects:
+        if rel.get_accessor_name() == name:
+            return rel.related_model,bool(rel.one_to_one),False
+    return None
+
+def walk_serializer(serializer,model,prefix,many,select,prefetch,depth=0,max_depth=5):
+    """ collects the relation paths read by the fields of serializer into select and prefetch """
+    if depth>max_depth:
+        return
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if isinstance(field,ListSerializer):
+            nested = field.child
+        elif isinstance(field,BaseSerializer):
+            nested = field
+        else:
+            nested = None
+        if field.source == '*':
+            if nested is not None:
+                walk_serializer(nested,model,prefix,many,select,prefetch,depth+1,max_depth)
+            continue
+        path,current,to_many,resolved,forward = prefix,model,many,True,False
+        for attr in field.source_attrs:
+            relation = get_relation(current,attr)
+            if relation is None:
+                resolved = False
+                break
+            current,single,forward = relation
+            last = path
+            path = '%s__%s' %(path,attr) if path else attr
+            to_many = to_many or not single
+        if resolved and isinstance(field,PrimaryKeyRelatedField) and forward and path!=prefix:
+            #primary key of a foreign key is read from its column
+            path = last
+        if path!=prefix:
+            (prefetch if to_many else select).append(path)
+        if resolved and nested is not None:
+            walk_serializer(nested,current,path,to_many,select,prefetch,depth+1,max_depth)
+
+def infer_relations(serializer_class,model):
+    """
+    select_related and prefetch_related paths needed to serialize rows of model with serializer_class,
+    derived from its fields (nested serializers, related fields and dotted sources). Computed once.
+    """
+    key = (serializer_class,model)
+    relations = _inferred_relations.get(key)
+    if relations is None:
+        select,prefetch = [],[]
+        try:
+            walk_serializer(serializer_class(),model,'',False,select,prefetch)
+        except Exception:
+            logger.warning('Could not infer relations of %s' %serializer_class.__name__,exc_info=True)
+            select,prefetch = [],[]
+        #prefix paths are implied by longer ones
+        select = [path for path in select if not any(other.startswith(path+'__') for other in select)]
+        relations = (tuple(OrderedDict.fromkeys(select)),tuple(OrderedDict.fromkeys(prefetch)))
+        _inferred_relations[key] = relations
+    return relations
+
+class InferRelatedMixin(object):
+    """
+    Applies select_related and prefetch_related inferred from the serializer to the filtered queryset,
+    when infer_related (or RELATED_VIEWS_INFER_RELATED setting) is set. Relations already selected or
+    prefetched by get_queryset are left out, those added are in inferred_relations attribute of the view.
+    """
+    infer_related = None
+
+    def is_infer_related(self):
+        infer_related = getattr(self,'infer_related',None)
+        if infer_related is None:
+            infer_related = getattr(settings,'RELATED_VIEWS_INFER_RELATED',False)
+        return bool(infer_related)
+
+    def get_inferred_relations(self,model):
+        return infer_relations(self.get_serializer_class(),model)
+
+    def apply_inferred_relations(self,queryset):
+        self.inferred_relations = {'select_related':[],'prefetch_related':[]}
+        if not self.is_infer_related() or not hasattr(queryset,'select_related'):
+            return queryset
+        #values querysets have no rows to attach relations to
+        if getattr(queryset,'_fields',None) is not None:
+            return queryset
+        select,prefetch = self.get_inferred_relations(queryset.model)
+        selected = queryset.query.select_related
+        if selected is True:
+            select = ()
+        elif isinstance(selected,dict):
+            select = [path for path in select if not self._is_selected(selected,path)]
+        prefetched = set(getattr(lookup,'prefetch_to',lookup) for lookup in queryset._prefetch_related_lookups)
+        prefetch = [path for path in prefetch if path not in prefetched]
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        self.inferred_relations = {'select_related':list(select),'prefetch_related':list(prefetch)}
+        if select or prefetch:
+            logger.debug('%s inferred select_related %s prefetch_related %s' %(self.__class__.__name__,list(select),list(prefetch)))
+        return queryset
+
+    def _is_selected(self,selected,path):
+        for attr in path.split('__'):
+            if attr not in selected:
+                return False
+            selected = selected[attr]
+        return True
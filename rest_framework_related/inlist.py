@@ -0,0 +1,141 @@
+from numbers import Integral
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+from django.core.exceptions import FieldDoesNotExist
+
+from .py2_3 import *
+
+class InList(object):
+    """
+    Applies `field__in=values` (or its exclusion) to a queryset choosing the SQL by list size and backend,
+    as long IN lists of bound parameters blow up the postgresql planner and hit the sqlite parameter limit.
+        in      - plain `__in` lookup, for lists up to plain_max values and on mysql
+        array   - `col = ANY(%s)` with the list as a single array parameter, postgresql
+        values  - `col IN (VALUES (1),(2),..)` with inlined integers, hash joined by postgresql
+                  above values_min values and used by sqlite for integer lists
+        chunked - primary keys of the queryset rows matching chunk_size values at a time are
+                  merged, then filtered by pk, for other lists and for lookups through relations
+        quoted  - `col IN ('a','b',..)` with values quoted by sqlite chunk_size at a time, for the
+                  primary keys of chunked on sqlite when they are not integers
+    """
+    plain_max = 1000
+    values_min = 10000
+    chunk_size = 500
+
+    def __init__(self,plain_max=None,values_min=None,chunk_size=None):
+        self.plain_max = plain_max or getattr(settings,'RELATED_VIEWS_IN_LIST_MAX',self.plain_max)
+        self.values_min = values_min or getattr(settings,'RELATED_VIEWS_IN_LIST_VALUES_MIN',self.values_min)
+        self.chunk_size = chunk_size or getattr(settings,'RELATED_VIEWS_IN_LIST_CHUNK',self.chunk_size)
+
+    def filter(self,queryset,field,values):
+        return self.apply(queryset,field,values,False)
+
+    def exclude(self,queryset,field,values):
+        return self.apply(queryset,field,values,True)
+
+    def apply(self,queryset,field,values,exclude=False,chunk=True):
+        method = queryset.exclude if exclude else queryset.filter
+        if not hasattr(queryset,'query'):
+            return method(**{'%s__in'%field:values})
+        values = list(OrderedDict.fromkeys(values)) if self.is_hashable(values) else list(values)
+        if len(values)<=self.plain_max:
+            return method(**{'%s__in'%field:values})
+        model_field = self.get_model_field(queryset,field)
+        if model_field is not None:
+            values = [model_field.get_prep_value(value) for value in values]
+        strategy = self.get_strategy(queryset,model_field,values)
+        if strategy == 'chunked' and not chunk:
+            #sqlite would bind them all in one statement
+            strategy = 'quoted' if model_field is not None and connections[queryset.db].vendor == 'sqlite' else 'in'
+        return getattr(self,'apply_%s'%strategy)(queryset,field,model_field,values,exclude)
+
+    def get_strategy(self,queryset,model_field,values):
+        vendor = connections[queryset.db].vendor
+        if vendor == 'mysql':
+            return 'in'
+        if model_field is None:
+            return 'chunked'
+        integers = all(isinstance(value,Integral) and not isinstance(value,bool) for value in values)
+        if vendor == 'postgresql':
+            return 'values' if integers and len(values)>=self.values_min else 'array'
+        return 'values' if integers else 'chunked'
+
+    def is_hashable(self,values):
+        try:
+            set(values)
+        except TypeError:
+            return False
+        return True
+
+    def get_model_field(self,queryset,field):
+        """ concrete field of the queryset model for a field name without relations, else None """
+        if '__' in field:
+            return None
+        opts = queryset.model._meta
+        if field == 'pk':
+            return opts.pk
+        try:
+            model_field = opts.get_field(field)
+        except FieldDoesNotExist:
+            return None
+        if not getattr(model_field,'concrete',False) or getattr(model_field,'many_to_many',False):
+            return None
+        return model_field
+
+    def get_column(self,queryset,model_field):
+        quote_name = connections[queryset.db].ops.quote_name
+        return '%s.%s' %(quote_name(queryset.model._meta.db_table),quote_name(model_field.column))
+
+    def get_where(self,column,condition,model_field,exclude):
+        if not exclude:
+            return condition
+        #exclude keeps null rows as django does
+        if model_field.null:
+            return 'NOT (%s) OR %s IS NULL' %(condition,column)
+        return 'NOT (%s)' %condition
+
+    def apply_in(self,queryset,field,model_field,values,exclude):
+        method = queryset.exclude if exclude else queryset.filter
+        return method(**{'%s__in'%field:values})
+
+    def apply_array(self,queryset,field,model_field,values,exclude):
+        column = self.get_column(queryset,model_field)
+        where = self.get_where(column,'%s = ANY(%%s)' %column,model_field,exclude)
+        return queryset.extra(where=[where],params=[values])
+
+    def apply_values(self,queryset,field,model_field,values,exclude):
+        column = self.get_column(queryset,model_field)
+        #integers only, inlined so that no parameter is bound
+        rows = ','.join('(%d)' %value for value in values)
+        where = self.get_where(column,'%s IN (VALUES %s)' %(column,rows),model_field,exclude)
+        return queryset.extra(where=[where])
+
+    def apply_quoted(self,queryset,field,model_field,values,exclude):
+        connection = connections[queryset.db]
+        values = [model_field.get_db_prep_value(value,connection,prepared=True) for value in values]
+        quoted = []
+        with connection.cursor() as cursor:
+            for start in range(0,len(values),self.chunk_size):
+                chunk = values[start:start+self.chunk_size]
+                cursor.execute('SELECT %s' %','.join(['QUOTE(%s)']*len(chunk)),chunk)
+                #inlined in sql which is formatted with the params of the queryset
+                quoted.extend(value.replace('%','%%') for value in cursor.fetchone())
+        column = self.get_column(queryset,model_field)
+        where = self.get_where(column,'%s IN (%s)' %(column,','.join(quoted)),model_field,exclude)
+        return queryset.extra(where=[where])
+
+    def apply_chunked(self,queryset,field,model_field,values,exclude):
+        #chunks of the queryset itself, so that its manager and filters narrow the primary keys
+        rows = queryset.order_by().values_list('pk',flat=True)
+        pks = set()
+        for start in range(0,len(values),self.chunk_size):
+            chunk = values[start:start+self.chunk_size]
+            pks.update(rows.filter(**{'%s__in'%field:chunk}))
+        return self.apply(queryset,'pk',sorted(pks),exclude,chunk=False)
+
+def get_in_list(view=None):
+    """ InList of the view (in_list_class attribute) or the default one """
+    in_list_class = getattr(view,'in_list_class',None) or InList
+    return in_list_class()
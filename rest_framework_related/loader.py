@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+import django
+from django.db import connections
+from django.db.models import F
+from django.core.exceptions import FieldDoesNotExist
+
+try:
+    from django.db.models import Window
+    from django.db.models.functions import RowNumber
+except ImportError:
+    # django < 2.0
+    Window = RowNumber = None
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+from .py2_3 import *
+
+class RelatedLoader(object):
+    """
+    Request scoped loader which coalesces the querysets of related views differing only in
+    the value of one field into a single `__in` query per model, e.g latest items of five categories.
+
+    Querysets are registered with add(name,queryset,field,value) where queryset is the
+    filtered queryset of the view without the field filter. Querysets having the same SQL are
+    grouped, every group of two or more views is fetched once by dispatch() and its rows are
+    split back per view, applying the slice (limit) of each view.
+
+    Sliced querysets are only coalesced when the rows of each value can be limited in SQL, with
+    ROW_NUMBER() partitioned by the field (django 4.2+ on databases supporting window functions),
+    otherwise each of them queries its own slice instead of the group loading every row.
+    """
+    row_number_field = '_related_loader_row'
+
+    def __init__(self):
+        self.groups = OrderedDict()
+        self.results = {}
+
+    def add(self,name,queryset,field,value):
+        if '__' in field:
+            return False
+        try:
+            attname = queryset.model._meta.get_field(field).attname
+        except FieldDoesNotExist:
+            return False
+        limits = (queryset.query.low_mark,queryset.query.high_mark)
+        if limits!=(0,None) and not self.can_limit_rows(queryset):
+            return False
+        queryset = queryset._clone()
+        queryset.query.clear_limits()
+        try:
+            sql = str(queryset.query)
+        except EmptyResultSet:
+            return False
+        group = self.groups.setdefault((queryset.model,field,sql),{'queryset':queryset,'attname':attname,'members':[]})
+        group['members'].append((name,value,limits))
+        return True
+
+    def dispatch(self):
+        for (model,field,sql),group in self.groups.items():
+            members = group['members']
+            if len(members)<2:
+                #nothing to coalesce, the view queries itself
+                continue
+            values = list(set(value for name,value,limits in members))
+            queryset = group['queryset'].filter(**{'%s__in'%field:values})
+            highs = [high for name,value,(low,high) in members]
+            if None not in highs:
+                queryset = self.limit_rows(queryset,field,max(highs))
+            rows = {}
+            for row in queryset:
+                rows.setdefault(str(getattr(row,group['attname'])),[]).append(row)
+            for name,value,(low,high) in members:
+                self.results[name] = rows.get(str(value),[])[low:high]
+        self.groups = OrderedDict()
+
+    def can_limit_rows(self,queryset):
+        """ whether limit_rows can be applied, filtering on window functions needs django 4.2 """
+        if Window is None or django.VERSION<(4,2):
+            return False
+        return connections[queryset.db].features.supports_over_clause
+
+    def limit_rows(self,queryset,field,high):
+        """ queryset limited to its first high rows of each value of field, in its own ordering """
+        query = queryset.query
+        if query.order_by:
+            ordering = list(query.order_by)
+        elif query.default_ordering:
+            ordering = list(query.get_meta().ordering)
+        else:
+            ordering = []
+        ordering = [order for order in ordering if order!='?'] or ['pk']
+        order_by = []
+        for order in ordering:
+            if not isinstance(order,(str,unicode)):
+                order_by.append(order)
+            elif order.startswith('-'):
+                order_by.append(F(order[1:]).desc())
+            else:
+                order_by.append(F(order).asc())
+        queryset = queryset.annotate(**{self.row_number_field:Window(RowNumber(),partition_by=[F(field)],order_by=order_by)})
+        return queryset.filter(**{'%s__lte'%self.row_number_field:high})
+
+    def get(self,name):
+        """ preloaded rows of the related view or None if it was not coalesced """
+        return self.results.get(name)
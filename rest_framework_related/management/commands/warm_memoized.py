@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from rest_framework_related.warmer import warm_memoized
+
+class Command(BaseCommand):
+    help = 'Refills the cache of memoized related views with their most frequent parameters'
+
+    def add_arguments(self,parser):
+        parser.add_argument('names',nargs='*',help='views to warm, as module.Class prefixes, all by default')
+        parser.add_argument('--top',type=int,default=100,help='parameter combinations replayed per view')
+        parser.add_argument('--workers',type=int,default=4,help='views replayed at the same time')
+        parser.add_argument('--host',help='host of the replayed requests, RELATED_VIEWS_WARM_HOST or ALLOWED_HOSTS by default')
+
+    def handle(self,*args,**options):
+        report = warm_memoized(top=options['top'],max_workers=options['workers'],names=options['names'] or None,
+                               host=options['host'])
+        for name,(replayed,computed) in report.items():
+            self.stdout.write('%s: %s replayed, %s computed' %(name,replayed,computed))
@@ -0,0 +1,99 @@
+import re
+import time
+import threading
+
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from django.db import connections
+
+from .py2_3 import *
+
+class QueryTracker(object):
+    """
+    Counts queries and their time on the connections of the current thread, as an execute
+    wrapper of each connection meanwhile (django 2.0+). Trackers may stop in any order.
+    Older django has no execute wrappers, the debug cursor is turned on and its queries_log read,
+    which miscounts once the log reaches its bound (9000 queries).
+    """
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self._connections = []
+
+    def __call__(self,execute,sql,params,many,context):
+        started = time.time()
+        try:
+            return execute(sql,params,many,context)
+        finally:
+            self.count += 1
+            self.duration += time.time()-started
+
+    def start(self):
+        for connection in connections.all():
+            if hasattr(connection,'execute_wrappers'):
+                connection.execute_wrappers.append(self)
+                self._connections.append((connection,None,None))
+            else:
+                self._connections.append((connection,connection.force_debug_cursor,len(connection.queries_log)))
+                connection.force_debug_cursor = True
+        return self
+
+    def stop(self):
+        for connection,force_debug_cursor,start in self._connections:
+            if start is None:
+                try:
+                    connection.execute_wrappers.remove(self)
+                except ValueError:
+                    pass
+                continue
+            queries = list(connection.queries_log)[start:]
+            connection.force_debug_cursor = force_debug_cursor
+            self.count += len(queries)
+            self.duration += sum(float(query.get('time') or 0) for query in queries)
+        self._connections = []
+        return self.count,self.duration*1000
+
+class RelatedMetrics(object):
+    """
+    Wall time, query count and time and memoization cache status of the main view
+    and of each related view of a request, in milliseconds.
+    """
+    def __init__(self):
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self,name):
+        return (name,time.time(),QueryTracker().start())
+
+    def stop(self,token,cache=None):
+        name,started,tracker = token
+        queries,query_time = tracker.stop()
+        entry = {'time':round((time.time()-started)*1000,2),'queries':queries,
+                 'query_time':round(query_time,2),'cache':cache}
+        with self._lock:
+            self.entries[name] = entry
+        return entry
+
+    @contextmanager
+    def measure(self,name):
+        """ measures the block, the cache status can be set on the yielded dict """
+        status = {'cache':None}
+        token = self.start(name)
+        try:
+            yield status
+        finally:
+            self.stop(token,status['cache'])
+
+    def as_data(self):
+        return OrderedDict((name,dict(entry)) for name,entry in self.entries.items())
+
+    def server_timing(self):
+        """ value of Server-Timing header """
+        metrics = []
+        for name,entry in self.entries.items():
+            desc = 'queries=%s query_time=%sms' %(entry['queries'],entry['query_time'])
+            if entry['cache']:
+                desc += ' cache=%s' %entry['cache']
+            metrics.append('%s;dur=%s;desc="%s"' %(re.sub(r'[^\w.-]','_',name),entry['time'],desc))
+        return ', '.join(metrics)
@@ -1,17 +1,71 @@
+import copy
+import time
+import hashlib
+import logging
+import threading
+
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
 from django.http.response import *
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = FutureTimeoutError = None
 
 from rest_framework.response import Response
 
-from .utility import subtractlists,Memoized,DummyRequest
+from .utility import cstolist,Memoized,MemoBatch,SubRequest,cache_value,model_label,get_model_versions
+from .loader import RelatedLoader
+from .metrics import RelatedMetrics
+from .plan import RelatedParams,RelatedPlan,RelatedViewMetaclass
 from .py2_3 import *
 
 AS_MAIN=1
 
-class RelatedView(object):
+logger = logging.getLogger(__name__)
+
+_related_executor = None
+_related_executor_lock = threading.Lock()
+#set in the threads of the executor, whose nested related views run sequentially
+_related_worker = threading.local()
+
+def get_related_executor():
+    """
+    Process wide ThreadPoolExecutor of concurrent related views, bounded to
+    RELATED_VIEWS_EXECUTOR_WORKERS threads (default 32) shared by all the requests.
+    """
+    global _related_executor
+    if _related_executor is None:
+        with _related_executor_lock:
+            if _related_executor is None:
+                _related_executor = ThreadPoolExecutor(max_workers=getattr(settings,'RELATED_VIEWS_EXECUTOR_WORKERS',32))
+    return _related_executor
+
+class RelatedView(with_metaclass(RelatedViewMetaclass,object)):
     '''View class makes a view callable from other view. '''
     relview = None
     jointrel = None
+    concurrent_related = None
+    related_max_workers = None
+    related_dependencies = None
+    deferred_related = False
+    related_metrics = None
+    related_metrics_member = None
+    related_time_budget = None
+    related_timeouts = None
+    degrade_related_views = None
+    related_partial_member = 'partial'
+    conditional_get = None
+    version_models = ()
+    page_cache_duration = None
+    page_fragment_durations = None
+    page_cache_main = False
     @classmethod
     def as_data(cls,**initkwargs):
         def view(request,*args,**kwargs):
@@ -21,7 +75,10 @@ class RelatedView(object):
             self.format_kwarg = None
             self.args = args
             self.kwargs = kwargs
-            resp =  self.get(request,*args,**kwargs)
+            try:
+                resp =  self.get(request,*args,**kwargs)
+            finally:
+                self.finalize_data(request)
             if isinstance(resp,Response):resp = resp.data
             return resp
 
@@ -34,6 +91,10 @@ class RelatedView(object):
         return view
 
 
+    def finalize_data(self,request):
+        """ called once a view called through as_data is done, which finalize_response is not """
+        pass
+
     #def set_related_params(self,params,request,responsedata):
     def set_related_params(self,request,responsedata):
         """ 
@@ -60,6 +121,10 @@ class RelatedView(object):
         """
         to update kwargs with query params with greater priority of kwargs.
         """
+        self.kwargs = self.get_updated_kwargs(request)
+
+    def get_updated_kwargs(self,request):
+        """ kwargs updated with query params, without setting them """
         updated_dict={}
         requrl = request.build_absolute_uri()
         urlparts = urlsplit(requrl)
@@ -67,95 +132,645 @@ class RelatedView(object):
         updated_dict = dict(parse_qs(unquote_query))
         updated_dict = { k:','.join(v) for k,v in updated_dict.items()}
         updated_dict.update(self.kwargs)
-
-        self.kwargs = updated_dict
+        return updated_dict
 
 
     def fetch_related(self,request,response,*args,**kwargs):
         ''' fetches data of related views and append to the result '''
+        self.stop_main_metrics()
+        if self.deferred_related:
+            #related views are fetched later by the async view, see aio.AsyncRelatedView.as_async_view
+            response.deferred_related = (self,request)
+            return response
         relateddata = {}
-
-        if not isinstance(response.data,dict):
+        #main data as it is before related views are merged, for the page cache
+        main = self.get_page_main(response)
+        reqviews = self.prepare_related(request,response)
+        if reqviews is None:
+            self.store_page_fragments(main,(),response.data,relateddata)
             response = self.get_final_response(request,response)
+            self.set_etag(response)
+            return self.report_related_metrics(request,response)
+        pending = []
+        if reqviews:
+            pending = self.splice_page_fragments(reqviews,response.data,relateddata)
+            self.start_related_deadline()
+            batch = self.prefetch_memoized(pending,request)
+            self.prime_related_loader(pending,request)
+            if self.is_concurrent_related():
+                self.fetch_related_concurrent(pending,request,response.data,relateddata,batch)
+            else:
+                for name in pending:
+                    self.set_pipelined_response(name,request,response.data)
+                    relobj = self.related_views.get(name,None)
+                    if relobj:
+                        dummyreq = self.get_related_request(request,relobj,name,batch)
+                        timeout = self.get_related_timeout(name)
+                        if timeout==0:
+                            resp = self.degrade_related(name,relobj,dummyreq,'time budget exhausted')
+                        else:
+                            started = time.time()
+                            try:
+                                resp = self.call_related_view(relobj,dummyreq)
+                            except Exception as exc:
+                                resp = self.degrade_related(name,relobj,dummyreq,exc)
+                            else:
+                                if timeout is not None and time.time()-started>timeout:
+                                    self.mark_late_related(name,time.time()-started)
+                        if resp is not None:
+                            self.merge_related_response(name,relobj,resp,response.data,relateddata)
+            if batch is not None:
+                batch.flush()
+            response.data['extdata']=relateddata
+            self.mark_partial_related(response.data)
+        self.store_page_fragments(main,pending,response.data,relateddata)
+        return self.finalize_related(request,response)
+
+    def get_related_metrics(self):
+        """
+        RelatedMetrics of this request when related_metrics (or RELATED_VIEWS_METRICS setting)
+        is enabled. Only the view serving the request collects them, not the related views.
+        """
+        if not hasattr(self,'_related_metrics'):
+            enabled = getattr(self,'related_metrics',None)
+            if enabled is None:
+                enabled = getattr(settings,'RELATED_VIEWS_METRICS',False)
+            enabled = enabled and getattr(self,'retType',None)!='data'
+            self._related_metrics = RelatedMetrics() if enabled else None
+        return self._related_metrics
+
+    def start_main_metrics(self):
+        """ starts measuring the main view, called from initial of the views """
+        metrics = self.get_related_metrics()
+        if metrics is not None:
+            self._main_metrics = metrics.start('main')
+
+    def stop_main_metrics(self):
+        #also creates the metrics before related views may run in other threads
+        metrics = self.get_related_metrics()
+        token = getattr(self,'_main_metrics',None)
+        if token is not None:
+            self._main_metrics = None
+            metrics.stop(token)
+
+    def report_related_metrics(self,request,response):
+        """
+        Adds the metrics as Server-Timing header and, when related_metrics_member
+        (or RELATED_VIEWS_METRICS_MEMBER setting) names one, as member of response data.
+        They are also passed to export_related_metrics.
+        """
+        metrics = self.get_related_metrics()
+        if metrics is None or not isinstance(response,(Response,HttpResponse)):
             return response
+        response['Server-Timing'] = metrics.server_timing()
+        member = getattr(self,'related_metrics_member',None) or getattr(settings,'RELATED_VIEWS_METRICS_MEMBER',None)
+        if member and isinstance(getattr(response,'data',None),dict):
+            response.data[member] = metrics.as_data()
+        self.export_related_metrics(request,metrics)
+        return response
+
+    def export_related_metrics(self,request,metrics):
+        """
+        hook to export metrics, calls RELATED_VIEWS_METRICS_HANDLER setting
+        (a callable or its dotted path) with view, request and metrics
+        """
+        handler = getattr(settings,'RELATED_VIEWS_METRICS_HANDLER',None)
+        if handler is None:
+            return
+        if isinstance(handler,str):
+            handler = import_string(handler)
+        handler(self,request,metrics)
+
+    def prepare_related(self,request,response):
+        """
+        returns the names of related views to be fetched for this response.
+        None means there is nothing to fetch and the response is returned as it is.
+        """
+        if not isinstance(response.data,dict):
+            return None
         # Retrieve the format of the response
         retformat=request.accepted_renderer.format
 
-
         #if hasattr(self,'retType') and self.retType=='data':
             #return response.data
         if not hasattr(self,'related_views') or len(self.related_views)==0:
-            response = self.get_final_response(request,response)
-            return response
+            return None
 
         reqviews = self.get_requested_views(request,retformat)
 
-        if reqviews:
-            #check if there is any related view
-            if isinstance(self.related_views,dict):
-                """
-                    A dummy request object is created here which has necessary attributes
-                    of original request.The idea is if we pass the original request,then its query_params
-                    attribute may have some keys which is common in related views but we dont want to
-                    pass it to related view( most common page). The arguments to the related view is 
-                    controlled by explicitly passing the name of view separated by colon(:) and the parameter
-                    to be passed. e.g self.filter_params['topics:page']=request.query_params.get('page',None)
-                """
-                dummyreq = DummyRequest(request)
-                self.updatekwargs(request)
-                self.set_related_params(request,response.data)
-                #self.set_related_params(updated_dict,request,response.data)
-                for name in reqviews:
-                    self.set_pipelined_response(name,request,response.data)
-                    relobj = self.related_views.get(name,None)
-                    dummyreq.query_params={}
-                    if relobj:
-                        #check that a name and handler function has been provided
-                        if len(relobj)<1:
-                            raise Exception('Related View must have a handler function')
-
-                        callback = relobj[0]
-                        #set the filters for this view which is passed in query_params attribute of request i.e dummyreq
-                        if isinstance(relobj[1],str):
-                            dummyreq.query_params = self.get_related_params(relobj[1],name)
-                        resp = callback(dummyreq,**dummyreq.query_params)
-                        if resp is None:
-                            raise Exception('The response must be of type Response,dict,list. None received')
-                        if type(resp) == Response:
-                            resp = resp.data
-                        if len(relobj)>2 and relobj[2]==1:
-                            response.data[name]=resp
-                        elif len(relobj)>1 and not isinstance(relobj[1],str) and relobj[1]==1:
-                            response.data[name]=resp
-                        else:
-                            relateddata[name]=resp
-                response.data['extdata']=relateddata
+        #check if there is any related view
+        if not reqviews or not isinstance(self.related_views,dict):
+            return []
+        """
+            A dummy request object is created for related views which has necessary attributes
+            of original request.The idea is if we pass the original request,then its query_params
+            attribute may have some keys which is common in related views but we dont want to
+            pass it to related view( most common page). The arguments to the related view is 
+            controlled by explicitly passing the name of view separated by colon(:) and the parameter
+            to be passed. e.g self.filter_params['topics:page']=request.query_params.get('page',None)
+        """
+        self.updatekwargs(request)
+        self.set_related_params(request,response.data)
+        #self.set_related_params(updated_dict,request,response.data)
+        return reqviews
+
+    def finalize_related(self,request,response):
+        """ applies get_final_response once related views data has been appended """
         response = self.get_final_response(request,response)
         if not isinstance(response,(Response,HttpResponse)):
             raise Exception("Expected a django `Response` type to be returned from %s" %self.get_final_response.__name__)
+        self.set_etag(response)
+        response = self.report_related_metrics(request,response)
         if hasattr(self,'retType') and self.retType=='data':
             return response.data
         return response
 
-    def get_related_params(self,param_str,viewname):
-        related_params = {}
-        param_str = param_str.strip(',')
-        parameters  = param_str.split(',')
-        for p in parameters:
-            p = p.strip()
-            if p == '*':
-                related_params.update(self.kwargs)
-            elif '=' in p:
-                p_split = p.split('=')
-                related_params[p_split[0]]=p_split[1].replace(':',',')
-            elif ' as ' in p:
-                p_split = p.split(' as ')
-                if self.kwargs.get(p_split[0]):
-                    related_params[p_split[1]]=self.kwargs.get(p_split[0])
+    def get_related_view_params(self,relobj,viewname):
+        """ parameters passed to the related view, taken from the parameter string of its declaration """
+        plan = self.get_related_plan()
+        if plan is not None and plan.related_views.get(viewname) is relobj:
+            return plan.get_params(viewname,self.kwargs)
+        if len(relobj)>1 and isinstance(relobj[1],str):
+            return self.get_related_params(relobj[1],viewname)
+        return {}
+
+    def get_related_request(self,request,relobj,viewname,batch=None):
+        """ request object passed to a related view """
+        #the filters for this view are passed in query_params attribute of request i.e dummyreq
+        dummyreq = SubRequest(request,self.get_related_view_params(relobj,viewname))
+        dummyreq.memo_batch = batch
+        dummyreq.related_name = viewname
+        loader = getattr(self,'_related_loader',None)
+        if loader is not None and self._loader_params.get(viewname) == dummyreq.query_params:
+            dummyreq.preloaded_queryset = loader.get(viewname)
+        return dummyreq
+
+    def prime_related_loader(self,reqviews,request):
+        """
+        Related views declaring batch_field (and optionally batch_param, the parameter holding its
+        value) are registered with a RelatedLoader, which fetches the ones differing only in that
+        value with one query. Memoized views are served from their cache and are left out.
+        The rows are passed to a view only if its parameters did not change in set_pipelined_response.
+        """
+        self._related_loader = None
+        self._loader_params = {}
+        loader = RelatedLoader()
+        for name in reqviews:
+            relobj = self.related_views.get(name,None)
+            if not relobj or isinstance(relobj[0],Memoized):
+                continue
+            viewcls = getattr(relobj[0],'_class',None)
+            field = getattr(viewcls,'batch_field',None)
+            if field is None or not hasattr(viewcls,'get_batch_queryset'):
+                continue
+            params = self.get_related_view_params(relobj,name)
+            param = getattr(viewcls,'batch_param',None) or field
+            values = cstolist(params.get(param))
+            if len(values)!=1:
+                continue
+            batchparams = dict((key,value) for key,value in params.items() if key!=param)
+            dummyreq = SubRequest(request,batchparams)
+            queryset = viewcls.get_batch_queryset(dummyreq,relobj[0]._initkwargs,batchparams)
+            #CountBackend returns a list for limit 0
+            if hasattr(queryset,'query') and loader.add(name,queryset,field,values[0]):
+                self._loader_params[name] = params
+        if self._loader_params:
+            loader.dispatch()
+            self._related_loader = loader
+        return self._related_loader
+
+    def prefetch_memoized(self,reqviews,request):
+        """
+        Fetches cache entries of all the requested memoized related views with a single get_many,
+        unless MEMOIZE_BATCH_LOOKUP setting is disabled. Keys are computed from the parameters known
+        before set_pipelined_response, a view whose parameters change afterwards looks up its own key.
+        Model versions of all the views are read at once and kept in the batch for their calls.
+        """
+        if not getattr(settings,'MEMOIZE_BATCH_LOOKUP',True):
+            return None
+        memoized = []
+        for name in reqviews:
+            relobj = self.related_views.get(name,None)
+            if relobj and isinstance(relobj[0],Memoized) and relobj[0]._memoize_renderer(request):
+                memoized.append((name,relobj))
+        labels = sorted(set(label for name,relobj in memoized for label in relobj[0]._model_labels))
+        versions = {}
+        get_model_versions(labels,versions)
+        keys = []
+        for name,relobj in memoized:
+            cache_key = relobj[0].get_cache_key(self.get_related_view_params(relobj,name),versions)
+            if not relobj[0].has_local_entry(cache_key):
+                keys.append(cache_key)
+        if len(keys)<2:
+            if not versions:
+                return None
+            keys = ()
+        return MemoBatch(keys,versions)
+
+    def call_related_view(self,relobj,request):
+        """ calls the handler function of a related view and returns its data """
+        #check that a name and handler function has been provided
+        if len(relobj)<1:
+            raise Exception('Related View must have a handler function')
+        callback = relobj[0]
+        def call():
+            return self.clean_related_response(callback(request,**request.query_params))
+        #set by batch.BatchView, the same view with the same params runs once per batch
+        registry = getattr(request,'related_registry',None)
+        metrics = self.get_related_metrics()
+        if metrics is None:
+            return call() if registry is None else registry.call(callback,request.query_params,call)
+        with metrics.measure(request.related_name) as status:
+            resp = call() if registry is None else registry.call(callback,request.query_params,call)
+            status['cache'] = getattr(request,'memo_status',None)
+        return resp
+
+    def clean_related_response(self,resp):
+        if resp is None:
+            raise Exception('The response must be of type Response,dict,list. None received')
+        if type(resp) == Response:
+            resp = resp.data
+        return resp
+
+    def is_related_as_main(self,relobj):
+        if len(relobj)>2 and relobj[2]==AS_MAIN:
+            return True
+        return len(relobj)>1 and not isinstance(relobj[1],str) and relobj[1]==AS_MAIN
+
+    def merge_related_response(self,name,relobj,resp,responsedata,relateddata):
+        """ appends data of related view either to main response(AS_MAIN) or to extdata """
+        if self.is_related_as_main(relobj):
+            responsedata[name]=resp
+        else:
+            relateddata[name]=resp
+
+    def is_concurrent_related(self):
+        """
+        related views are executed concurrently if the view sets concurrent_related
+        or else if RELATED_VIEWS_CONCURRENT setting is enabled, except within a worker of the
+        shared executor which would otherwise wait for threads of its own pool
+        """
+        if getattr(_related_worker,'active',False):
+            return False
+        concurrent = getattr(self,'concurrent_related',None)
+        if concurrent is None:
+            concurrent = getattr(settings,'RELATED_VIEWS_CONCURRENT',False)
+        return bool(concurrent)
+
+    def get_related_dependencies(self,name):
+        """
+        names of related views whose response must be merged before `name` is called.
+        Declare them with related_dependencies = {'view':('otherview',..)} on the view class
+        """
+        dependencies = getattr(self,'related_dependencies',None) or {}
+        return dependencies.get(name,())
+
+    def pop_ready_related(self,order,pending,merged):
+        """
+        removes and returns the pending positions of order whose related view can be called now,
+        i.e none of its dependencies requested before it is waiting to be merged
+        """
+        ready = []
+        for index in list(pending):
+            dependencies = self.get_related_dependencies(order[index])
+            if any(order[waiting] in dependencies for waiting in range(merged,index)):
+                continue
+            pending.remove(index)
+            ready.append(index)
+        return ready
+
+    def _call_related_in_worker(self,relobj,request):
+        _related_worker.active = True
+        try:
+            return self.call_related_view(relobj,request)
+        finally:
+            _related_worker.active = False
+            #connections are thread local, so the ones opened by this worker are closed here
+            connections.close_all()
+
+    def fetch_related_concurrent(self,reqviews,request,responsedata,relateddata,batch=None):
+        """
+        Executes related views on the process wide executor (see get_related_executor), at most
+        related_max_workers (or RELATED_VIEWS_MAX_WORKERS) of them at once for this request.
+        A view which declares dependencies is called only after the responses of the views it
+        depends on (requested before it) have been merged, so set_pipelined_response sees them
+        as in sequential mode. Responses are always merged in the order of reqviews.
+        Views which time out are left running in the background instead of holding the response.
+        """
+        if ThreadPoolExecutor is None:
+            raise ImproperlyConfigured('Concurrent related views require concurrent.futures (pip install futures on python 2)')
+        executor = get_related_executor()
+        order = list(reqviews)
+        max_workers = getattr(self,'related_max_workers',None) or getattr(settings,'RELATED_VIEWS_MAX_WORKERS',4)
+        max_workers = max(1,max_workers)
+        pending = list(range(len(order)))
+        #ready views waiting for a worker of this request, by index
+        queued = []
+        futures = {}
+        merged = 0
+        while merged < len(order):
+            for index in self.pop_ready_related(order,pending,merged):
+                name = order[index]
+                self.set_pipelined_response(name,request,responsedata)
+                relobj = self.related_views.get(name,None)
+                if relobj:
+                    #every worker gets its own request object as query_params differ per view
+                    queued.append((index,relobj,self.get_related_request(request,relobj,name,batch)))
+            queued.sort(key=lambda entry:entry[0])
+            running = sum(1 for entry in futures.values() if entry[2] is not None and not entry[2].done())
+            #the view merged next is always submitted, it is the one waited for
+            while queued and (running<max_workers or queued[0][0]==merged):
+                index,relobj,dummyreq = queued.pop(0)
+                timeout = self.get_related_timeout(order[index])
+                deadline = None if timeout is None else time.time()+timeout
+                future = None if timeout==0 else executor.submit(self._call_related_in_worker,relobj,dummyreq)
+                if future is not None:
+                    running += 1
+                futures[index] = (relobj,dummyreq,future,deadline)
+            if merged in futures:
+                name = order[merged]
+                relobj,dummyreq,future,deadline = futures.pop(merged)
+                if future is None:
+                    resp = self.degrade_related(name,relobj,dummyreq,'time budget exhausted')
+                else:
+                    try:
+                        resp = future.result(None if deadline is None else max(0,deadline-time.time()))
+                    except FutureTimeoutError:
+                        future.cancel()
+                        resp = self.degrade_related(name,relobj,dummyreq,'timed out')
+                    except Exception as exc:
+                        resp = self.degrade_related(name,relobj,dummyreq,exc)
+                if resp is not None:
+                    self.merge_related_response(name,relobj,resp,responsedata,relateddata)
+            merged += 1
+
+    def start_related_deadline(self):
+        """ starts the time budget (related_time_budget or RELATED_VIEWS_TIME_BUDGET seconds) of related views """
+        budget = getattr(self,'related_time_budget',None)
+        if budget is None:
+            budget = getattr(settings,'RELATED_VIEWS_TIME_BUDGET',None)
+        self._related_deadline = None if budget is None else time.time()+budget
+        self._partial_related = []
+
+    def get_related_timeout(self,name):
+        """
+        seconds related view `name` may take: its related_timeouts entry (or RELATED_VIEWS_TIMEOUT),
+        capped by what is left of the time budget. None means no limit and 0 that the budget is exhausted.
+        Only concurrent and async related views are interrupted. Sequential ones run to completion:
+        they are skipped once the budget is exhausted, and those which took longer than their
+        timeout are kept but listed as partial (see mark_late_related).
+        """
+        timeouts = getattr(self,'related_timeouts',None) or {}
+        timeout = timeouts.get(name,getattr(settings,'RELATED_VIEWS_TIMEOUT',None))
+        deadline = getattr(self,'_related_deadline',None)
+        if deadline is not None:
+            remaining = max(0,deadline-time.time())
+            timeout = remaining if timeout is None else min(timeout,remaining)
+        return timeout
+
+    def is_degrade_related(self):
+        degrade = getattr(self,'degrade_related_views',None)
+        if degrade is None:
+            degrade = getattr(settings,'RELATED_VIEWS_DEGRADE',False)
+        return bool(degrade)
+
+    def degrade_related(self,name,relobj,request,error):
+        """
+        Called when related view `name` failed (error is the exception) or ran out of time.
+        Exceptions are raised again unless degrade_related_views (or RELATED_VIEWS_DEGRADE) is set.
+        Returns the last cached data of a memoized view, or None to leave the view out,
+        and marks the response partial.
+        """
+        if isinstance(error,Exception) and not self.is_degrade_related():
+            raise error
+        logger.warning('Related view %s of %s degraded: %s',name,self.__class__.__name__,error,
+                       exc_info=isinstance(error,Exception))
+        self._partial_related.append(name)
+        callback = relobj[0]
+        if isinstance(callback,Memoized):
+            try:
+                return callback.get_cached_value(request.query_params)
+            except Exception:
+                logger.exception('Cached data of related view %s could not be read',name)
+        return None
+
+    def mark_late_related(self,name,elapsed):
+        """ related view `name` ran in sequential mode past its timeout, its data is kept but marked partial """
+        logger.warning('Related view %s of %s took %.3fs, past its timeout',name,self.__class__.__name__,elapsed)
+        self._partial_related.append(name)
+
+    def mark_partial_related(self,responsedata):
+        """ lists degraded related views under related_partial_member of the response data """
+        if self._partial_related:
+            responsedata[self.related_partial_member] = list(self._partial_related)
+
+    def is_conditional_get(self):
+        conditional_get = getattr(self,'conditional_get',None)
+        if conditional_get is None:
+            conditional_get = getattr(settings,'RELATED_VIEWS_CONDITIONAL_GET',False)
+        return bool(conditional_get)
+
+    def get_version_token(self,request):
+        """
+        Cheap token of the data of the main view which changes whenever that data changes,
+        e.g max updated_at of the rows. None means unknown and disables conditional GET.
+        Defaults to the versions of version_models, bumped when any of their rows is saved or deleted.
+        """
+        return self.__class__.get_related_version_token(request,self.kwargs)
+
+    @classmethod
+    def get_related_version_token(cls,request,params):
+        """
+        Token of the data of this view called as related view with params, None if unknown.
+        Defaults to the versions of version_models, else of cache_models of memoized views.
+        """
+        models = cls.version_models or getattr(cls,'cache_models',())
+        if not models:
+            return None
+        #registered by RelatedViewMetaclass when the class is created
+        return get_model_versions([model_label(model) for model in models])
+
+    def get_etag(self,request):
+        """
+        ETag of the composed response, made of the version tokens of this view and of every
+        requested related view along with the url, the media type and the user.
+        None when any of the tokens is unknown.
+        """
+        token = self.get_version_token(request)
+        if token is None:
+            return None
+        tokens = [str(token)]
+        if isinstance(getattr(self,'related_views',None),dict) and self.related_views:
+            reqviews = self.get_requested_views(request,request.accepted_renderer.format) or []
+            plan = self.get_related_plan()
+            kwargs = self.get_updated_kwargs(request)
+            for name in reqviews:
+                relobj = self.related_views.get(name,None)
+                if not relobj:
+                    continue
+                callback = relobj[0]
+                viewcls = getattr(callback,'_class',None) or getattr(getattr(callback,'_func',None),'_class',None)
+                if not hasattr(viewcls,'get_related_version_token'):
+                    return None
+                params = plan.get_params(name,kwargs) if plan is not None else {}
+                token = viewcls.get_related_version_token(request,params)
+                if token is None:
+                    return None
+                tokens.append('%s:%s' %(name,token))
+        user = getattr(request,'user',None)
+        user_key = user.pk if getattr(user,'is_authenticated',False) else ''
+        cls = self.__class__
+        key = '|'.join(['%s.%s'%(cls.__module__,cls.__name__),request.get_full_path(),
+                        str(getattr(request,'accepted_media_type','')),str(user_key)]+tokens)
+        return 'W/"%s"' %hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def check_not_modified(self,request):
+        """
+        With conditional_get (or RELATED_VIEWS_CONDITIONAL_GET setting) set, returns a 304 response when
+        If-None-Match of the request holds the ETag of the response, before anything is serialized or any
+        related view is called. Otherwise returns None and the ETag is set on the response by fetch_related.
+        """
+        self._etag = None
+        if getattr(self,'retType',None)=='data' or request.method not in ('GET','HEAD') or not self.is_conditional_get():
+            return None
+        self._etag = etag = self.get_etag(request)
+        if etag is None:
+            return None
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            #weak comparison
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            if '*' in tags or etag[2:] in [tag[2:] if tag.startswith('W/') else tag for tag in tags]:
+                response = Response(status=304)
+                response['ETag'] = etag
+                return response
+        return None
+
+    def set_etag(self,response):
+        etag = getattr(self,'_etag',None)
+        if etag and getattr(self,'retType',None)!='data' and getattr(response,'status_code',200)==200:
+            response['ETag'] = etag
+
+    def get_page_cache_duration(self):
+        duration = getattr(self,'page_cache_duration',None)
+        if duration is None:
+            duration = getattr(settings,'RELATED_VIEWS_PAGE_CACHE_DURATION',None)
+        return duration
+
+    def get_fragment_duration(self,name):
+        """ seconds the data of related view `name` is kept, page_fragment_durations entry or page_cache_duration """
+        durations = getattr(self,'page_fragment_durations',None) or {}
+        return durations.get(name,self.get_page_cache_duration())
+
+    def get_page_cache_key(self,request,reqviews):
+        """
+        Key prefix of the cached fragments of a page, made of the view, its kwargs updated with
+        query params, the requested related views, the media type and the user.
+        """
+        kwargs = self.get_updated_kwargs(request)
+        kwargs.pop('format',None)
+        params = urlencode(sorted((key,cache_value(value)) for key,value in kwargs.items()))
+        user = getattr(request,'user',None)
+        user_key = user.pk if getattr(user,'is_authenticated',False) else ''
+        cls = self.__class__
+        key = '|'.join(['%s.%s'%(cls.__module__,cls.__name__),params,','.join(reqviews),
+                        str(getattr(request,'accepted_media_type','')),str(user_key)])
+        return 'page:%s' %hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_cached_page(self,request,*args,**kwargs):
+        """
+        Page cache, enabled by page_cache_duration (or RELATED_VIEWS_PAGE_CACHE_DURATION setting).
+        The data of each related view is cached as a separate fragment expiring independently
+        (see page_fragment_durations), all fetched with one get_many. None is returned and the main
+        view runs as usual (get_object, object permissions, applied filters...), only the expired
+        related views are called and the fresh fragments are spliced in.
+        With page_cache_main set the data of the main view is cached too and when it is fresh the
+        page is assembled and returned without running the main view: only for views without
+        object level permissions nor instance state read by related params or get_final_response.
+        Only the data of responses is cached, not headers.
+        """
+        self._page_key = None
+        self._page_fragments = {}
+        self._page_main_cached = False
+        if getattr(self,'retType',None)=='data' or request.method not in ('GET','HEAD') or not self.get_page_cache_duration():
+            return None
+        reqviews = []
+        if isinstance(getattr(self,'related_views',None),dict) and self.related_views:
+            reqviews = list(self.get_requested_views(request,request.accepted_renderer.format) or [])
+        if not reqviews and not self.page_cache_main:
+            return None
+        self._page_key = key = self.get_page_cache_key(request,reqviews)
+        keys = dict(('%s:%s'%(key,name),name) for name in reqviews)
+        if self.page_cache_main:
+            keys['%s:__main__'%key] = None
+        cached = cache.get_many(list(keys))
+        self._page_fragments = dict((keys[fragment_key],value) for fragment_key,value in cached.items() if keys[fragment_key])
+        main = cached.get('%s:__main__'%key)
+        if main is None:
+            return None
+        self._page_main_cached = True
+        return self.fetch_related(request,Response(main),*args,**kwargs)
+
+    def get_page_main(self,response):
+        """ main data as it is before related views are merged when it is to be cached, see page_cache_main """
+        if self.page_cache_main and getattr(self,'_page_key',None) and not self._page_main_cached:
+            return copy.copy(response.data)
+        return None
+
+    def splice_page_fragments(self,reqviews,responsedata,relateddata):
+        """ merges the fresh fragments of the page cache, returns the related views still to be called """
+        fragments = getattr(self,'_page_fragments',None) or {}
+        pending = []
+        for name in reqviews:
+            relobj = self.related_views.get(name,None)
+            if relobj and name in fragments:
+                self.merge_related_response(name,relobj,fragments[name],responsedata,relateddata)
             else:
-                if self.kwargs.get(p):
-                    related_params[p]=self.kwargs.get(p)
-        return related_params
+                pending.append(name)
+        return pending
+
+    def store_page_fragments(self,main,names,responsedata,relateddata):
+        """ caches the main data (unless it came from the cache) and the data of related views `names` """
+        key = getattr(self,'_page_key',None)
+        if not key:
+            return
+        fragments = {}
+        if main is not None:
+            fragments.setdefault(self.get_page_cache_duration(),{})['%s:__main__'%key] = main
+        #degraded views are not cached
+        partial = set(getattr(self,'_partial_related',None) or ())
+        for name in names:
+            relobj = self.related_views.get(name,None)
+            duration = self.get_fragment_duration(name)
+            if not relobj or name in partial or not duration:
+                continue
+            data = responsedata if self.is_related_as_main(relobj) else relateddata
+            if name in data:
+                fragments.setdefault(duration,{})['%s:%s'%(key,name)] = data[name]
+        for duration,values in fragments.items():
+            cache.set_many(values,duration)
+
+    def get_related_params(self,param_str,viewname):
+        return RelatedParams(param_str,viewname).project(self.kwargs)
+
+    def get_related_plan(self):
+        """
+        compiled related_views of the view class, or compiled now when related_views
+        of this instance differs from the class one (e.g set through initkwargs)
+        """
+        plan = self._related_plan
+        if plan is not None and plan.related_views is self.related_views:
+            return plan
+        if not isinstance(getattr(self,'related_views',None),dict):
+            return None
+        #compiled once per instance, keyed by the id of the dict it was compiled from
+        key = id(self.related_views)
+        cached = self.__dict__.get('_instance_related_plan')
+        if cached is not None and cached[0] == key and cached[1].related_views is self.related_views:
+            return cached[1]
+        plan = RelatedPlan(self.related_views)
+        self._instance_related_plan = (key,plan)
+        return plan
 
     def get_requested_views(self,request,returnformat):
         """get requested views from request.query_params.relview"""
@@ -172,18 +787,8 @@ class RelatedView(object):
             reqviews = 'all'
         if self.jointrel is not None:
             reqviews = reqviews+','+self.jointrel
-        if reqviews:
-            reqviews = reqviews.split(',')
-            relviews = self.related_views.keys()
-            include = []
-            exclude = []
-            for reqview in reqviews:
-                if reqview == 'all':
-                    include += relviews
-                elif reqview[0] == '-':
-                    exclude.append(reqview[1:])
-                elif reqview not in include:
-                    include.append(reqview)
-            reqviews = subtractlists(include,exclude)
+        plan = self.get_related_plan()
+        if reqviews and plan is not None:
+            reqviews = plan.get_requested(reqviews)
         return reqviews
 
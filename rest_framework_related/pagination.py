@@ -0,0 +1,268 @@
+import json
+import base64
+import hashlib
+import datetime
+
+from functools import partial
+from collections import OrderedDict
+
+from django.db import connections
+from django.db.models import Q
+from django.core.cache import cache
+from django.core.paginator import Paginator as DjangoPaginator
+from django.core.exceptions import ImproperlyConfigured, ValidationError, FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.utils.urls import replace_query_param
+
+from .utility import cache_value
+from .py2_3 import *
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+class CursorEncoder(DjangoJSONEncoder):
+    """ DjangoJSONEncoder keeping the microseconds of datetimes and times, which it truncates to milliseconds """
+    def default(self,o):
+        if isinstance(o,(datetime.datetime,datetime.time)):
+            return o.isoformat()
+        return super(CursorEncoder,self).default(o)
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination over the ordering applied by OrderBackend, so that every
+    page costs the same as the first one instead of an OFFSET scan.
+
+    The ordering is taken from view.applied_ordering set by OrderBackend, else from the
+    queryset or model ordering, and pk is added as tiebreaker. The next link carries an opaque
+    cursor holding the sort key of the last row. Ordering fields must not be null.
+    Use with pagination_class=KeysetPagination as view attribute.
+    """
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = None
+    max_page_size = None
+    cursor_query_param = 'cursor'
+    tiebreaker = 'pk'
+    display_page_controls = False
+    invalid_cursor_message = 'Invalid cursor'
+    #the cursor is read from model instances, see ListAPIView.get_values_mapping
+    requires_instances = True
+    #pages are filtered and ordered in SQL, see ListAPIView.get_pk_cache_key
+    requires_queryset = True
+
+    def paginate_queryset(self,queryset,request,view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        if not hasattr(queryset,'query'):
+            return self.paginate_list(queryset,request)
+        self.ordering = self.get_ordering(queryset,view)
+        queryset = queryset.order_by(*self.ordering)
+        values = self.decode_cursor(request,queryset.model)
+        if values is not None:
+            queryset = queryset.filter(self.get_keyset_filter(values))
+        rows = list(queryset[:self.page_size+1])
+        self.has_next = len(rows)>self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def paginate_list(self,rows,request):
+        """
+        Offset pagination of rows which are not a queryset (e.g preloaded by the RelatedLoader),
+        already in their order. The cursor holds the offset of the page.
+        """
+        self.ordering = None
+        values = self.decode_cursor(request)
+        self.offset = values[0] if values is not None else 0
+        rows = list(rows[self.offset:self.offset+self.page_size+1])
+        self.has_next = len(rows)>self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self,request):
+        if self.page_size_query_param:
+            try:
+                page_size = int(request.query_params[self.page_size_query_param])
+                if page_size>0:
+                    return min(page_size,self.max_page_size) if self.max_page_size else page_size
+            except (KeyError,ValueError):
+                pass
+        return self.page_size
+
+    def get_ordering(self,queryset,view):
+        ordering = getattr(view,'applied_ordering',None) or queryset.query.order_by or queryset.model._meta.ordering
+        ordering = list(ordering or [])
+        if not all(isinstance(field,(str,unicode)) and field!='?' for field in ordering):
+            raise ImproperlyConfigured('KeysetPagination supports ordering by field names only, got %s' %ordering)
+        pk = queryset.model._meta.pk
+        if not any(field.lstrip('-') in ('pk',pk.name,pk.attname) for field in ordering):
+            descending = bool(ordering) and ordering[-1].startswith('-')
+            ordering.append('-'+self.tiebreaker if descending else self.tiebreaker)
+        return ordering
+
+    def get_keyset_filter(self,values):
+        """ rows after values in ordering: (a>x) | (a=x & b>y) | ... with < for descending fields """
+        keyset = Q()
+        for index,field in enumerate(self.ordering):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition = Q(**{'%s__%s' %(field.lstrip('-'),lookup):values[index]})
+            for previous,value in zip(self.ordering[:index],values[:index]):
+                condition &= Q(**{previous.lstrip('-'):value})
+            keyset |= condition
+        return keyset
+
+    def get_row_key(self,row):
+        values = []
+        for field in self.ordering:
+            value = row
+            for attr in field.lstrip('-').split('__'):
+                value = getattr(value,attr)
+            values.append(getattr(value,'pk',value))
+        return values
+
+    def encode_cursor(self,row):
+        if self.ordering is None:
+            values = [self.offset+self.page_size]
+        else:
+            values = self.get_row_key(row)
+        data = json.dumps([self.ordering,values],cls=CursorEncoder)
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self,request,model=None):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            ordering,values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        except (TypeError,ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        #a cursor of another ordering can not be continued
+        if ordering!=self.ordering or not isinstance(values,list):
+            raise NotFound(self.invalid_cursor_message)
+        if ordering is None:
+            if len(values)!=1 or not isinstance(values[0],int) or isinstance(values[0],bool) or values[0]<0:
+                raise NotFound(self.invalid_cursor_message)
+            return values
+        if len(values)!=len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        if model is not None:
+            values = self.clean_cursor_values(model,values)
+        return values
+
+    def clean_cursor_values(self,model,values):
+        """ values of the cursor converted by the model fields of the ordering, NotFound if invalid """
+        cleaned = []
+        for field,value in zip(self.ordering,values):
+            try:
+                cleaned.append(self.get_ordering_field(model,field.lstrip('-')).to_python(value))
+            except (FieldDoesNotExist,ValidationError,TypeError,ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        return cleaned
+
+    def get_ordering_field(self,model,name):
+        """ model field of an ordering name, following relations e.g category__name """
+        field = None
+        for attr in name.split('__'):
+            if field is not None:
+                model = field.related_model
+            field = model._meta.pk if attr=='pk' else model._meta.get_field(attr)
+        return field
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),self.cursor_query_param,self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self,data):
+        return Response(OrderedDict([('next',self.get_next_link()),('results',data)]))
+
+    def get_results(self,data):
+        return data['results']
+
+
+class CountedPaginator(DjangoPaginator):
+    """ django Paginator with a count computed beforehand """
+    def __init__(self,object_list,per_page,count=None,**kwargs):
+        super(CountedPaginator,self).__init__(object_list,per_page,**kwargs)
+        if count is not None:
+            self.__dict__['count'] = count
+
+class CachedCountPagination(PageNumberPagination):
+    """
+    Page number pagination which caches the count of the filtered queryset for count_cache_duration
+    seconds, keyed by the view (class and initkwargs) and the SQL of the queryset without ordering,
+    instead of running COUNT(*) on every request.
+
+    With count_cap set, counting stops at count_cap rows. Above it the count is the planner
+    estimate when count_estimate is set and the database is postgresql, else count_cap,
+    and the response has count_exact false.
+    """
+    count_cache_duration = 60
+    count_cap = None
+    count_estimate = False
+
+    def paginate_queryset(self,queryset,request,view=None):
+        self.count_exact = True
+        count = self.get_count(queryset,view)
+        self.django_paginator_class = partial(CountedPaginator,count=count)
+        return super(CachedCountPagination,self).paginate_queryset(queryset,request,view)
+
+    def get_count_cache_key(self,queryset,view):
+        try:
+            #ordering does not change the count
+            key = str(queryset.order_by().query)
+        except EmptyResultSet:
+            key = ''
+        cls = view.__class__
+        initkwargs = urlencode(sorted((name,cache_value(value)) for name,value in (getattr(view,'_initkwargs',None) or {}).items()))
+        model = queryset.model._meta
+        key = '%s.%s:%s:%s.%s:%s' %(cls.__module__,getattr(cls,'__qualname__',cls.__name__),initkwargs,model.app_label,model.model_name,key)
+        return 'count:%s' %hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_count(self,queryset,view):
+        if not hasattr(queryset,'query'):
+            return len(queryset)
+        cache_key = self.get_count_cache_key(queryset,view)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            count,self.count_exact = cached
+            return count
+        count = self.count_queryset(queryset)
+        cache.set(cache_key,(count,self.count_exact),self.count_cache_duration)
+        return count
+
+    def count_queryset(self,queryset):
+        if not self.count_cap:
+            return queryset.count()
+        count = queryset[:self.count_cap+1].count()
+        if count<=self.count_cap:
+            return count
+        self.count_exact = False
+        estimate = self.estimate_count(queryset) if self.count_estimate else None
+        return max(estimate or 0,self.count_cap)
+
+    def estimate_count(self,queryset):
+        """ row estimate of the postgresql planner, None on other databases """
+        connection = connections[queryset.db]
+        if connection.vendor!='postgresql':
+            return None
+        sql,params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) %s' %sql,params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan,(str,unicode)):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def get_paginated_response(self,data):
+        response = super(CachedCountPagination,self).get_paginated_response(data)
+        response.data['count_exact'] = self.count_exact
+        return response
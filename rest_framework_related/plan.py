@@ -0,0 +1,134 @@
+from django.core.exceptions import ImproperlyConfigured
+
+from .utility import register_cache_models
+from .py2_3 import *
+
+class RelatedParams(object):
+    """
+    Compiled parameter string of a related view declaration, e.g '*,page=1,cat as category,tag'
+        *           - pass all kwargs of the main view
+        key=value   - pass a constant, colons in value are replaced by commas
+        name as key - pass kwarg name of the main view as key if it is set
+        name        - pass kwarg name of the main view if it is set
+    Parts are applied in the given order, so later ones override earlier ones.
+    """
+    ALL,CONSTANT,ALIAS,NAME = range(4)
+    __slots__ = ('param_str','operations')
+
+    def __init__(self,param_str,viewname=None):
+        self.param_str = param_str
+        operations = []
+        for p in param_str.strip(',').split(','):
+            p = p.strip()
+            if not p:
+                continue
+            if p == '*':
+                operations.append((self.ALL,None,None))
+            elif '=' in p:
+                p_split = p.split('=')
+                if len(p_split)!=2 or not p_split[0].strip():
+                    self._invalid(p,viewname)
+                operations.append((self.CONSTANT,p_split[0],p_split[1].replace(':',',')))
+            elif ' as ' in p:
+                p_split = [each.strip() for each in p.split(' as ')]
+                if len(p_split)!=2 or not all(p_split):
+                    self._invalid(p,viewname)
+                operations.append((self.ALIAS,p_split[0],p_split[1]))
+            elif ' ' in p:
+                self._invalid(p,viewname)
+            else:
+                operations.append((self.NAME,p,p))
+        self.operations = tuple(operations)
+
+    def _invalid(self,part,viewname):
+        raise ImproperlyConfigured('Invalid parameter "%s" in "%s" of related view %s' %(part,self.param_str,viewname))
+
+    def project(self,kwargs):
+        """ parameters for the related view from kwargs of the main view """
+        related_params = {}
+        for operation,source,target in self.operations:
+            if operation == self.ALL:
+                related_params.update(kwargs)
+            elif operation == self.CONSTANT:
+                related_params[source] = target
+            else:
+                value = kwargs.get(source)
+                if value:
+                    related_params[target] = value
+        return related_params
+
+class RelatedPlan(object):
+    """
+    related_views declaration of a view compiled once: handlers are validated,
+    parameter strings parsed and requested view strings resolved to view names.
+    """
+    max_requested_cache = 256
+
+    def __init__(self,related_views):
+        self.related_views = related_views
+        self.names = tuple(related_views.keys())
+        self.params = {}
+        for name,relobj in related_views.items():
+            if not isinstance(relobj,(list,tuple)) or len(relobj)<1 or not callable(relobj[0]):
+                raise ImproperlyConfigured('Related View %s must have a handler function' %name)
+            if len(relobj)>1 and isinstance(relobj[1],str):
+                self.params[name] = RelatedParams(relobj[1],name)
+        self._requested = {}
+
+    def get_params(self,viewname,kwargs):
+        params = self.params.get(viewname)
+        if params is None:
+            return {}
+        return params.project(kwargs)
+
+    def get_requested(self,reqviews):
+        """
+        names of the views requested by a comma separated string in which `all` means every
+        related view and a name prefixed with `-` is excluded
+        """
+        requested = self._requested.get(reqviews)
+        if requested is None:
+            requested = self._resolve(reqviews)
+            if len(self._requested)<self.max_requested_cache:
+                self._requested[reqviews] = requested
+        return list(requested)
+
+    def _resolve(self,reqviews):
+        include = []
+        included = set()
+        exclude = set()
+        for reqview in reqviews.split(','):
+            if not reqview:
+                continue
+            if reqview[0] == '-':
+                exclude.add(reqview[1:])
+                continue
+            for name in (self.names if reqview == 'all' else (reqview,)):
+                if name not in included:
+                    included.add(name)
+                    include.append(name)
+        return tuple(name for name in include if name not in exclude)
+
+class RelatedViewMetaclass(type):
+    """
+    compiles related_views of the view class when it is created, so that errors surface at import,
+    and registers the models whose versions key its cached data, see get_version_models
+    """
+    def __init__(cls,name,bases,attrs):
+        super(RelatedViewMetaclass,cls).__init__(name,bases,attrs)
+        related_views = getattr(cls,'related_views',None)
+        if isinstance(related_views,dict) and related_views:
+            cls._related_plan = RelatedPlan(related_views)
+        else:
+            cls._related_plan = None
+        models = cls.get_version_models()
+        if models:
+            #in every process importing the view, so that saves made anywhere bump the versions
+            register_cache_models(models)
+
+    def get_version_models(cls):
+        """ models whose versions are part of cache keys of the view """
+        models = list(getattr(cls,'pk_cache_models',None) or ())
+        #ETag tokens, see RelatedView.get_related_version_token
+        models += list(getattr(cls,'version_models',None) or getattr(cls,'cache_models',None) or ())
+        return models
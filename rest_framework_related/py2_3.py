@@ -6,3 +6,13 @@ except ImportError:
     # Python 2 only:
     from urlparse import parse_qs, urlsplit
     from urllib import urlencode, unquote
+
+try:
+    unicode = unicode
+except NameError:
+    # Python 3 only:
+    unicode = str
+
+def with_metaclass(meta, *bases):
+    """ base class with metaclass meta, for both python 2 and 3 syntax """
+    return meta('NewBase', bases, {})
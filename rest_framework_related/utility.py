@@ -1,14 +1,26 @@
-import types, sys, copy, hashlib
+import types, sys, copy, time, pickle, random, hashlib, threading
 
 from itertools import chain
+from collections import OrderedDict
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # python 2
+    from collections import MutableMapping
 from operator import itemgetter
 
-from django.db import models
+from django.db import models, transaction
 from django.http import Http404
 from django.conf import settings
-from django.core.cache import cache
+from django.core.cache import cache, caches
+from django.db.models.signals import post_save, post_delete
 from django.shortcuts import render
-from django.core.urlresolvers import reverse
+try:
+    from django.urls import reverse
+except ImportError:
+    # django < 1.10
+    from django.core.urlresolvers import reverse
 from django.core.exceptions import FieldError
 
 from rest_framework import status
@@ -88,7 +100,8 @@ def cstolist(value):
         #do typecasting
         rawvalues=value.split(',')
         if rawvalues[0].isdigit():
-            value = [int(v) for v in rawvalues]
+            #map runs int in C, noticeably faster for long id lists
+            value = list(map(int,rawvalues))
         else:
             value = list(rawvalues)
     elif isinstance(value,(int,)):
@@ -138,52 +151,544 @@ class NoPagination(object):
     def get_results(self, data):
         return data['results']
 
+class CachedPkList(object):
+    """
+    Filtered rows of a queryset given by their ordered primary keys.
+    Len and count need no query, slices fetch their rows with pk__in keeping the order.
+    """
+    chunk_size = 1000
+
+    def __init__(self,queryset,pks):
+        self.queryset = queryset
+        self.model = queryset.model
+        self.pks = pks
+
+    def __len__(self):
+        return len(self.pks)
+
+    def count(self):
+        return len(self.pks)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            pks = self.pks[index]
+            rows = self.queryset.in_bulk(pks)
+            return [rows[pk] for pk in pks if pk in rows]
+        return self[index:index+1 or None][0]
+
+    def __iter__(self):
+        for start in range(0,len(self.pks),self.chunk_size):
+            for row in self[start:start+self.chunk_size]:
+                yield row
+
+class LocalCache(object):
+    """
+    Bounded in-process LRU cache with per entry ttl, used in front of django cache by Memoized.
+    Values are kept pickled so that callers never share mutable objects.
+    """
+    def __init__(self,max_entries=1000,max_bytes=64*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self,key,default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1]<=time.time():
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._data.pop(key)
+            self._data[key] = item
+            self.hits += 1
+        return pickle.loads(item[0])
+
+    def contains(self,key):
+        """ whether a live entry is kept for key, without unpickling it nor counting a hit or a miss """
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[1]>time.time()
+
+    def set(self,key,value,timeout):
+        data = pickle.dumps(value,pickle.HIGHEST_PROTOCOL)
+        if len(data)>self.max_bytes:
+            #the older value must not outlive the newer one which does not fit
+            self.delete(key)
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (data,time.time()+timeout)
+            self.size += len(data)
+            while len(self._data)>self.max_entries or self.size>self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def delete(self,key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _remove(self,key):
+        self.size -= len(self._data.pop(key)[0])
+
+    def stats(self):
+        return {'entries':len(self._data),'bytes':self.size,'hits':self.hits,
+                'misses':self.misses,'evictions':self.evictions}
+
+_local_cache = None
+
+def get_local_cache():
+    """ process wide LocalCache sized by MEMOIZE_LOCAL_MAX_ENTRIES and MEMOIZE_LOCAL_MAX_BYTES settings """
+    global _local_cache
+    if _local_cache is None:
+        _local_cache = LocalCache(max_entries=getattr(settings,'MEMOIZE_LOCAL_MAX_ENTRIES',1000),
+                                  max_bytes=getattr(settings,'MEMOIZE_LOCAL_MAX_BYTES',64*1024*1024))
+    return _local_cache
+
+def cache_value(value):
+    """ canonical string of a parameter value used in cache keys """
+    if isinstance(value,(list,tuple)):
+        return ','.join(cache_value(each) for each in value)
+    return value if isinstance(value,(str,unicode)) else str(value)
+
+def model_label(model):
+    """ app_label.modelname of a model class or of a 'app_label.ModelName' string """
+    if isinstance(model,(str,unicode)):
+        return model.lower()
+    return '%s.%s' %(model._meta.app_label,model._meta.model_name)
+
+def _model_version_key(label):
+    return 'memoize:version:%s'%label
+
+def get_model_versions(labels,known=None):
+    """
+    Current version of each model label, as a string folded in memoized cache keys.
+    A missing version is initialised with the current time so that it never repeats an evicted one.
+    Versions found in known (label -> version) are not fetched, the fetched ones are added to it.
+    """
+    if not labels:
+        return ''
+    if known is None:
+        known = {}
+    missing = [label for label in labels if label not in known]
+    if missing:
+        keys = dict((_model_version_key(label),label) for label in missing)
+        versions = cache.get_many(list(keys))
+        for key,label in keys.items():
+            if versions.get(key) is None:
+                cache.add(key,int(time.time()*1000),None)
+                versions[key] = cache.get(key)
+            known[label] = versions[key]
+    return '.'.join(str(known[label]) for label in labels)
+
+def bump_model_version(model):
+    """ invalidates all the memoized data depending on model """
+    key = _model_version_key(model_label(model))
+    if not cache.add(key,int(time.time()*1000),None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            #evicted in between
+            cache.add(key,int(time.time()*1000),None)
+
+#label of a saved model -> labels of the registered models whose version it bumps
+_version_triggers = {}
+
+def _bump_model_version_receiver(sender,using=None,**kwargs):
+    labels = set(_version_triggers.get(model_label(sender),()))
+    #saves through a proxy model (register_as_proxy_model) are saves of its concrete model
+    concrete = getattr(getattr(sender,'_meta',None),'concrete_model',sender)
+    if concrete is not sender:
+        labels.update(_version_triggers.get(model_label(concrete),()))
+    if not labels:
+        return
+    def bump():
+        for label in labels:
+            bump_model_version(label)
+    #after commit, so that data recomputed under the new version is the committed one,
+    #and nothing is bumped for a rolled back write. Runs at once outside transactions.
+    transaction.on_commit(bump,using=using)
+
+def register_cache_models(models):
+    """
+    Bumps the version of models (classes or 'app_label.ModelName' strings) on post_save and post_delete
+    of them, of their proxies and of their concrete model. Related views declare them with cache_models attribute.
+    """
+    for model in models:
+        label = model_label(model)
+        _version_triggers.setdefault(label,set()).add(label)
+        concrete = getattr(getattr(model,'_meta',None),'concrete_model',None)
+        if concrete is not None and concrete is not model:
+            _version_triggers.setdefault(model_label(concrete),set()).add(label)
+    if _version_triggers:
+        for signal in (post_save,post_delete):
+            signal.connect(_bump_model_version_receiver,weak=False,dispatch_uid='memoize_version')
+
+class AccessLog(object):
+    """
+    Sampled frequency table of the parameters a memoized view is called with, bounded to max_entries.
+    Samples are counted in process, replacing the least frequent entry when full, and merged every
+    flush_every samples into a table kept in the cache named by MEMOIZE_WARM_CACHE setting (default),
+    which should outlive flushes of the data cache. Read by warmer.warm_memoized.
+    """
+    def __init__(self,name,sample_rate,max_entries=1000,flush_every=100):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.counts = {}
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def get_cache(self):
+        return caches[getattr(settings,'MEMOIZE_WARM_CACHE','default')]
+
+    def get_cache_key(self):
+        return 'memoize:warm:%s' %hashlib.sha1(self.name.encode('utf-8')).hexdigest()
+
+    def record(self,kwargs):
+        if random.random()>=self.sample_rate:
+            return
+        params = tuple(sorted((key,cache_value(value)) for key,value in kwargs.items() if key!='format'))
+        with self._lock:
+            counts = self.counts
+            if params in counts:
+                counts[params] += 1
+            elif len(counts)<self.max_entries:
+                counts[params] = 1
+            else:
+                least = min(counts,key=counts.get)
+                counts[params] = counts.pop(least)+1
+            self.samples += 1
+            if self.samples<self.flush_every:
+                return
+            counts,self.counts,self.samples = self.counts,{},0
+        self.flush(counts)
+
+    def merge(self,table,counts):
+        for params,count in counts.items():
+            table[params] = table.get(params,0)+count
+        if len(table)>self.max_entries:
+            table = dict(sorted(table.items(),key=itemgetter(1),reverse=True)[:self.max_entries])
+        return table
+
+    def flush(self,counts=None):
+        """ merges counts (the pending ones by default) into the shared table """
+        if counts is None:
+            with self._lock:
+                counts,self.counts,self.samples = self.counts,{},0
+        if not counts:
+            return
+        warm_cache = self.get_cache()
+        table = self.merge(warm_cache.get(self.get_cache_key()) or {},counts)
+        warm_cache.set(self.get_cache_key(),table,None)
+
+    def top(self,count):
+        """ the count most frequent parameters, as dicts """
+        table = self.merge(dict(self.get_cache().get(self.get_cache_key()) or {}),dict(self.counts))
+        return [dict(params) for params,hits in sorted(table.items(),key=itemgetter(1),reverse=True)[:count]]
+
+#memoized views by name, replayed by warmer.warm_memoized
+_memoized_registry = OrderedDict()
+
 class Memoized(object):
+    """
+    Caches the data returned by a related view in django cache.
+
+    Options read from the view class (or settings):
+        cache_duration - seconds the data is fresh (MEMOIZE_DURATION)
+        cache_stale_duration - seconds expired data is still served while a single
+            request recomputes it (MEMOIZE_STALE_DURATION, default 0)
+        cache_lock_timeout - on a miss only the request holding a lock of this many seconds
+            recomputes the data, others wait for it (MEMOIZE_LOCK_TIMEOUT, default 0 i.e no lock)
+        local_cache_duration - seconds the data is also kept in the in-process LocalCache
+            in front of django cache (MEMOIZE_LOCAL_DURATION, default 0 i.e disabled)
+        cache_models - models the data depends on. Saving or deleting any of their instances
+            bumps the model version which is part of the cache key, invalidating the data
+        cache_warm_sample - fraction of calls whose parameters are recorded in an AccessLog,
+            replayed by the warm_memoized command (MEMOIZE_WARM_SAMPLE, default 0 i.e disabled)
+        cache_warm_max_entries - parameter combinations kept by the AccessLog (MEMOIZE_WARM_MAX_ENTRIES)
+    """
     excluded_renderer = ('api','json')
+    lock_poll_interval = 0.05
 
     def __init__(self, func):
         self._func = func
+        self._model_labels = [model_label(model) for model in getattr(func._class,'cache_models',())]
+        register_cache_models(getattr(func._class,'cache_models',()))
+        cls = func._class
+        self.name = '%s.%s:%s' %(cls.__module__,cls.__name__,urlencode(sorted((key,cache_value(value)) for key,value in func._initkwargs.items())))
+        sample_rate = self._get_option('cache_warm_sample','MEMOIZE_WARM_SAMPLE',0)
+        self.access_log = None
+        if sample_rate:
+            self.access_log = AccessLog(self.name,sample_rate,self._get_option('cache_warm_max_entries','MEMOIZE_WARM_MAX_ENTRIES',1000))
+        _memoized_registry[self.name] = self
 
     def __repr__(self):
         return self._func.__repr__()
 
-    def _create_cache_key(self,args,kwargs,initkwargs):
+    def _get_option(self,name,setting,default=None):
+        return getattr(self._func._class,name,getattr(settings,setting,default))
+
+    def _create_cache_key(self,args,kwargs,initkwargs,versions=None):
         kwargs.update(initkwargs)
         kwargs.pop('format','')
-        filters = urlencode(kwargs)
-        cache_key = hashlib.sha1('%s:%s' %(self._func.__name__,filters)).hexdigest()
-        return cache_key[:250]
+        #sorted so that the same parameters always give the same key
+        filters = urlencode(sorted((key,cache_value(value)) for key,value in kwargs.items()))
+        versions = get_model_versions(self._model_labels,versions)
+        cache_key = '%s:%s:%s' %(self._func.__name__,filters,versions)
+        return hashlib.sha1(cache_key.encode('utf-8')).hexdigest()
     
-    def _get_set_cache(self,args,kwargs,cache_key):
+    def get_cache_key(self,kwargs,versions=None):
+        """ cache key of the view called with kwargs, without modifying kwargs """
+        return self._create_cache_key((),dict(kwargs),self._func._initkwargs,versions)
+
+    def get_cached_value(self,kwargs):
+        """ cached data of the view called with kwargs even if stale, None if there is none """
+        entry = self._cache_get(self.get_cache_key(kwargs))
+        return None if entry is None else entry[0]
+
+    def get_local_entry(self,cache_key):
+        local_duration = self._get_option('local_cache_duration','MEMOIZE_LOCAL_DURATION',0)
+        if local_duration:
+            return get_local_cache().get(cache_key)
+        return None
+
+    def has_local_entry(self,cache_key):
+        local_duration = self._get_option('local_cache_duration','MEMOIZE_LOCAL_DURATION',0)
+        return bool(local_duration) and get_local_cache().contains(cache_key)
+
+    def _cache_get(self,cache_key,batch=None):
+        entry = self.get_local_entry(cache_key)
+        if entry is not None:
+            return entry
+        if batch is not None and batch.has(cache_key):
+            entry = batch.get(cache_key)
+        else:
+            entry = cache.get(cache_key)
+        local_duration = self._get_option('local_cache_duration','MEMOIZE_LOCAL_DURATION',0)
+        if entry is not None and local_duration:
+            get_local_cache().set(cache_key,entry,local_duration)
+        return entry
+
+    def _cache_set(self,cache_key,entry,timeout,batch=None):
+        if batch is not None:
+            batch.set(cache_key,entry,timeout)
+        else:
+            cache.set(cache_key,entry,timeout)
+        local_duration = self._get_option('local_cache_duration','MEMOIZE_LOCAL_DURATION',0)
+        if local_duration:
+            get_local_cache().set(cache_key,entry,min(local_duration,timeout))
+
+    def _get_set_cache(self,args,kwargs,cache_key,batch=None):
         value = self._func(*args,**kwargs)
-        cache_duration = getattr(self._func._class,'cache_duration',settings.MEMOIZE_DURATION)
-        cache.set(cache_key,value,cache_duration)
+        cache_duration = self._get_option('cache_duration','MEMOIZE_DURATION')
+        stale_duration = self._get_option('cache_stale_duration','MEMOIZE_STALE_DURATION',0)
+        #data is stored along with the time till which it is fresh, it is kept for stale_duration after that
+        self._cache_set(cache_key,(value,time.time()+cache_duration),cache_duration+stale_duration,batch)
         return value
 
     def _memoize_renderer(self,request):
         return request.accepted_renderer.format not in self.excluded_renderer
 
+    def _acquire_lock(self,cache_key,timeout):
+        return cache.add('%s:lock'%cache_key,1,timeout)
+
+    def _release_lock(self,cache_key):
+        cache.delete('%s:lock'%cache_key)
+
+    def _wait_for_cache(self,cache_key,timeout):
+        """ wait for the request holding the lock to set the data """
+        deadline = time.time()+timeout
+        while time.time()<deadline:
+            time.sleep(self.lock_poll_interval)
+            entry = cache.get(cache_key)
+            if entry is not None:
+                return entry
+        return None
+
+    def _recompute(self,args,kwargs,cache_key,stale_entry=None,batch=None):
+        lock_timeout = self._get_option('cache_lock_timeout','MEMOIZE_LOCK_TIMEOUT',0)
+        if not lock_timeout and stale_entry is not None:
+            #only one request may refresh stale data, the others keep serving it
+            lock_timeout = self._get_option('cache_stale_duration','MEMOIZE_STALE_DURATION',0)
+        if not lock_timeout:
+            #without lock nobody waits for the data, so it can be written along with the batch
+            return self._get_set_cache(args,kwargs,cache_key,batch)
+        if self._acquire_lock(cache_key,lock_timeout):
+            try:
+                return self._get_set_cache(args,kwargs,cache_key)
+            finally:
+                self._release_lock(cache_key)
+        if stale_entry is not None:
+            #another request is refreshing it
+            return stale_entry[0]
+        entry = self._wait_for_cache(cache_key,lock_timeout)
+        if entry is not None:
+            return entry[0]
+        #lock holder took too long, compute it here
+        return self._get_set_cache(args,kwargs,cache_key)
+
+    def _set_status(self,request,status):
+        """ cache status of the call, read by RelatedView metrics """
+        try:
+            request.memo_status = status
+        except AttributeError:
+            pass
+
+    def warm(self,request,kwargs):
+        """ computes and caches the data of the view called with kwargs unless it is fresh, True if computed """
+        #the view is called with kwargs completed as in __call__, so the data matches its key
+        kwargs = dict(kwargs)
+        cache_key = self._create_cache_key((),kwargs,self._func._initkwargs)
+        entry = cache.get(cache_key)
+        if entry is not None and entry[1]>time.time():
+            return False
+        self._get_set_cache((SubRequest(request,dict(kwargs)),),kwargs,cache_key)
+        return True
+
     def __call__(self, *args, **kwargs):
-        cache_key = self._create_cache_key(args,kwargs,self._func._initkwargs)
-        cache_data = self._memoize_renderer(args[0]) and cache.get(cache_key)
-        return cache_data or self._get_set_cache(args,kwargs,cache_key)
-
-class DummyRequest(object):
-    """  
-        A substitute for rest_framework request object which provides mutable query_params attribute. 
-        All the related views are passed DummyRequest instance.The request data that is passed to Related Views are inserted into ites query_params attribute.
-    """
-    def __init__(self,request,data=None):
-        if data is None:
-            data = {}
+        if self.access_log is not None:
+            self.access_log.record(kwargs)
+        #set by RelatedView.fetch_related when cache entries of its related views are fetched together
+        batch = getattr(args[0],'memo_batch',None)
+        cache_key = self._create_cache_key(args,kwargs,self._func._initkwargs,getattr(batch,'versions',None))
+        if not self._memoize_renderer(args[0]):
+            self._set_status(args[0],'bypass')
+            return self._get_set_cache(args,kwargs,cache_key)
+        entry = self._cache_get(cache_key,batch)
+        if entry is None:
+            self._set_status(args[0],'miss')
+            return self._recompute(args,kwargs,cache_key,batch=batch)
+        value,fresh_till = entry
+        if fresh_till>time.time():
+            self._set_status(args[0],'hit')
+            return value
+        self._set_status(args[0],'stale')
+        return self._recompute(args,kwargs,cache_key,stale_entry=entry,batch=batch)
+
+class MemoBatch(object):
+    """
+    Cache entries of several memoized related views fetched with a single get_many.
+    Data computed for the misses is written back with set_many (one call per timeout) on flush.
+    versions holds the model versions read once for the cache keys of all the views.
+    """
+    def __init__(self,keys,versions=None):
+        self.keys = set(keys)
+        self.versions = versions if versions is not None else {}
+        self.entries = cache.get_many(list(self.keys)) if self.keys else {}
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def has(self,key):
+        return key in self.keys
+
+    def get(self,key):
+        return self.entries.get(key)
+
+    def set(self,key,entry,timeout):
+        with self._lock:
+            self.pending.setdefault(timeout,{})[key] = entry
+
+    def flush(self):
+        with self._lock:
+            pending,self.pending = self.pending,{}
+        for timeout,entries in pending.items():
+            cache.set_many(entries,timeout)
+
+class CopyOnWriteParams(MutableMapping):
+    """ query_params of a SubRequest sharing the given dict until it is first written """
+    __slots__ = ('_data','_shared')
+
+    def __init__(self,data=None):
+        self._shared = data is not None
+        self._data = data if data is not None else {}
+
+    def _own(self):
+        if self._shared:
+            self._data = dict(self._data)
+            self._shared = False
+
+    def __getitem__(self,key):
+        return self._data[key]
+
+    def get(self,key,default=None):
+        return self._data.get(key,default)
+
+    def __contains__(self,key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self,key,value):
+        self._own()
+        self._data[key] = value
+
+    def __delitem__(self,key):
+        self._own()
+        del self._data[key]
+
+    def update(self,*args,**kwargs):
+        self._own()
+        self._data.update(*args,**kwargs)
+
+    def copy(self):
+        return dict(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+class SubRequest(object):
+    """
+    Request passed to a related view, one per related view call. The hot attributes of the main
+    request (user, accepted_renderer, session, META, method) are copied into slots, others are read
+    from the main request only when missing here, and query_params are copy on write, so that a view
+    changing them affects neither the main request nor any other related view.
+    State of the call (memo_batch, related_name, memo_status, preloaded_queryset) is always set here,
+    never read from the main request. related_registry of a batch is passed down to nested views.
+    """
+    __slots__ = ('_request','_query_params','isDummy','data','user','accepted_renderer','session','META','method',
+                 'memo_batch','related_name','memo_status','preloaded_queryset','related_registry')
+    proxied = ('user','accepted_renderer','session','META','method')
+
+    def __init__(self,request,query_params=None,data=None):
         self._request = request
-        self.query_params = {}
+        for name in self.proxied:
+            setattr(self,name,getattr(request,name,None))
+        self.query_params = query_params
         self.isDummy = True
-        self.data = data
-    
-    def __getattr__(self, name):
-        try:
-            return self.__getattribute__(name)
-        except AttributeError:
-            return getattr(self._request,name)
+        self.data = data if data is not None else {}
+        self.memo_batch = None
+        self.related_name = None
+        self.memo_status = None
+        self.preloaded_queryset = None
+        self.related_registry = getattr(request,'related_registry',None)
+
+    @property
+    def query_params(self):
+        return self._query_params
+
+    @query_params.setter
+    def query_params(self,value):
+        self._query_params = value if isinstance(value,CopyOnWriteParams) else CopyOnWriteParams(value)
+
+    def __getattr__(self,name):
+        #called only for attributes not set on the subrequest
+        if name == '_request':
+            raise AttributeError(name)
+        return getattr(self._request,name)
 
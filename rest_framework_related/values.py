@@ -0,0 +1,114 @@
+import logging
+
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+
+from rest_framework import fields as drf_fields
+from rest_framework.serializers import Serializer, BaseSerializer
+from rest_framework.relations import PrimaryKeyRelatedField
+
+from .inference import get_relation
+from .py2_3 import *
+
+logger = logging.getLogger(__name__)
+
+#(serializer class,model) -> ValuesMapping or False when the serializer can not be mapped
+_values_mappings = {}
+
+def _function(method):
+    return getattr(method,'__func__',method)
+
+#fields whose to_representation returns the database value unchanged
+IDENTITY_FIELDS = (drf_fields.CharField,drf_fields.IntegerField,drf_fields.BooleanField,
+                   getattr(drf_fields,'NullBooleanField',drf_fields.BooleanField),drf_fields.ReadOnlyField)
+
+class ValuesMapping(object):
+    """
+    Serializer compiled to a mapping of .values() rows to output dicts, for serializers of plain
+    model fields, forward foreign keys as primary keys and dotted sources through them.
+    Each entry is (field name,values key,converter) where converter is None for fields whose
+    representation is the database value, else the to_representation of the field.
+    """
+    def __init__(self,entries):
+        self.entries = tuple(entries)
+        self.keys = tuple(OrderedDict.fromkeys(key for name,key,convert in self.entries))
+
+    def map_row(self,row):
+        data = OrderedDict()
+        for name,key,convert in self.entries:
+            value = row[key]
+            data[name] = value if convert is None or value is None else convert(value)
+        return data
+
+    def map_rows(self,rows):
+        map_row = self.map_row
+        return [map_row(row) for row in rows]
+
+def get_converter(field):
+    if isinstance(field,PrimaryKeyRelatedField):
+        pk_field = getattr(field,'pk_field',None)
+        return pk_field.to_representation if pk_field is not None else None
+    method = _function(type(field).to_representation)
+    if any(method is _function(cls.to_representation) for cls in IDENTITY_FIELDS):
+        return None
+    return field.to_representation
+
+def get_values_key(field,model):
+    """ values() key of the field source or None when it is not a column reachable by to one relations """
+    attrs = field.source_attrs
+    path = []
+    current = model
+    for index,attr in enumerate(attrs):
+        relation = get_relation(current,attr)
+        if relation is None:
+            #last attribute must be a concrete column
+            if index!=len(attrs)-1:
+                return None
+            try:
+                model_field = current._meta.get_field(attr)
+            except FieldDoesNotExist:
+                return None
+            if model_field.is_relation or not getattr(model_field,'concrete',False):
+                return None
+            path.append(attr)
+            return '__'.join(path)
+        current,single,forward = relation
+        if not (single and forward):
+            return None
+        path.append(attr)
+    #a foreign key itself, which is its primary key in values()
+    if isinstance(field,PrimaryKeyRelatedField):
+        return '__'.join(path)
+    return None
+
+def compile_values_mapping(serializer_class,model):
+    if _function(serializer_class.to_representation) is not _function(Serializer.to_representation):
+        return None
+    serializer = serializer_class()
+    entries = []
+    for name,field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if isinstance(field,BaseSerializer) or field.source == '*' or isinstance(field,drf_fields.SerializerMethodField):
+            return None
+        key = get_values_key(field,model)
+        if key is None:
+            return None
+        entries.append((name,key,get_converter(field)))
+    return ValuesMapping(entries)
+
+def get_values_mapping(serializer_class,model):
+    """ ValuesMapping of serializer_class for rows of model or None, compiled once """
+    key = (serializer_class,model)
+    mapping = _values_mappings.get(key)
+    if mapping is None:
+        try:
+            mapping = compile_values_mapping(serializer_class,model)
+        except Exception:
+            logger.warning('Could not compile values mapping of %s' %serializer_class.__name__,exc_info=True)
+            mapping = None
+        if mapping is None:
+            logger.debug('%s is serialized with model instances' %serializer_class.__name__)
+        mapping = _values_mappings[key] = mapping or False
+    return mapping or None
@@ -1,11 +1,22 @@
+import json
+import hashlib
+import logging
+
 from datetime import datetime
+from itertools import islice
 from operator import itemgetter
 from collections import OrderedDict
 
-from django.core.urlresolvers import resolve,reverse
+try:
+    from django.urls import resolve,reverse
+except ImportError:
+    # django < 1.10
+    from django.core.urlresolvers import resolve,reverse
 from django.http.request import QueryDict
 from django.utils.http import is_safe_url
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import prefetch_related_objects
 from django.http.response import *
 
 from rest_framework.views import APIView as GAPIView
@@ -13,24 +24,164 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.request import Request
 from rest_framework import generics
+from rest_framework.utils import encoders
 
 from .mixins import RelatedView
-from .utility import is_ajax
+from .inference import InferRelatedMixin
+from .values import get_values_mapping
+from .flow import get_flow_store_class
+from .utility import is_ajax, NoPagination, CachedPkList, cache_value, model_label, get_model_versions
 from .py2_3 import *
 
-class ListAPIView(generics.ListAPIView,RelatedView):
+logger = logging.getLogger(__name__)
+
+class ListAPIView(InferRelatedMixin,generics.ListAPIView,RelatedView):
+    #cache of filtered primary keys, see get_pk_cache_key
+    pk_cache_duration = None
+    pk_cache_models = ()
+    pk_cache_max_size = 10000
+    #stream unpaginated json responses, see stream_list
+    stream_response = False
+    stream_chunk_size = 500
+    stream_error_message = 'The list could not be sent completely'
+    #serialize .values() rows without model instances, see get_values_mapping
+    values_fast_path = None
+
+    def __init__(self,**kwargs):
+        #keys of cached data depend on them, see pagination.CachedCountPagination.get_count_cache_key
+        self._initkwargs = kwargs
+        super(ListAPIView,self).__init__(**kwargs)
+
+    def initial(self,request,*args,**kwargs):
+        self.start_main_metrics()
+        super(ListAPIView,self).initial(request,*args,**kwargs)
+
+    def finalize_response(self,request,response,*args,**kwargs):
+        #detaches the query tracker when fetch_related was not reached (denied, 404, 304, errors)
+        self.stop_main_metrics()
+        return super(ListAPIView,self).finalize_response(request,response,*args,**kwargs)
 
     def list(self,request,*args,**kwargs):
         """ 
         Overridden generics.ListAPIView list method to provide additional 
         functionality of related views data fetching and applied filters addition
         """
-        response=super(ListAPIView,self).list(request,*args,**kwargs)
+        not_modified = self.check_not_modified(request)
+        if not_modified is not None:
+            return not_modified
+        if self.is_stream_response(request):
+            queryset = self.filter_queryset(self.get_queryset())
+            #CountBackend switches to NoPagination while filtering
+            if self.paginator is None or isinstance(self.paginator,NoPagination):
+                response = self.stream_list(request,queryset,*args,**kwargs)
+                self.set_etag(response)
+                return response
+            response=self.get_list_response(queryset)
+        else:
+            cached = self.get_cached_page(request,*args,**kwargs)
+            if cached is not None:
+                return cached
+            if self.is_values_fast_path():
+                response=self.get_list_response(self.filter_queryset(self.get_queryset()))
+            else:
+                response=super(ListAPIView,self).list(request,*args,**kwargs)
         #add applied_filters to the response which is set when filter_queryset method is called
         response=self.addAppliedFilters(response)
         #fetch data from the related views
         return self.fetch_related(request,response,*args,**kwargs)
 
+    def get_list_response(self,queryset):
+        """ generics.ListAPIView list for an already filtered queryset """
+        mapping = self.get_values_mapping(queryset)
+        if mapping is not None:
+            queryset = self.get_values_queryset(queryset,mapping)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            data = mapping.map_rows(page) if mapping else self.get_serializer(page,many=True).data
+            return self.get_paginated_response(data)
+        data = mapping.map_rows(queryset) if mapping else self.get_serializer(queryset,many=True).data
+        return Response(data)
+
+    def is_values_fast_path(self):
+        values_fast_path = getattr(self,'values_fast_path',None)
+        if values_fast_path is None:
+            values_fast_path = getattr(settings,'RELATED_VIEWS_VALUES_FAST_PATH',False)
+        return bool(values_fast_path)
+
+    def get_values_mapping(self,queryset):
+        """
+        Mapping of .values() rows to the serializer output when values_fast_path is set, else None.
+        It is None as well for serializers which need model instances (nested serializers, method
+        fields, to many relations, overridden to_representation), for querysets already evaluated
+        (cached primary keys, preloaded rows) and for paginations reading model instances.
+        """
+        if not self.is_values_fast_path() or not hasattr(queryset,'values') or not hasattr(queryset,'query'):
+            return None
+        if getattr(self.paginator,'requires_instances',False):
+            return None
+        return get_values_mapping(self.get_serializer_class(),queryset.model)
+
+    def get_values_queryset(self,queryset,mapping):
+        #relations are joined by values() itself
+        return queryset.prefetch_related(None).values(*mapping.keys)
+
+    def is_stream_response(self,request):
+        if getattr(self,'retType',None)=='data':
+            return False
+        stream = getattr(self,'stream_response',None)
+        if stream is None:
+            stream = getattr(settings,'RELATED_STREAM_RESPONSE',False)
+        return bool(stream) and request.accepted_renderer.format=='json'
+
+    def stream_list(self,request,queryset,*args,**kwargs):
+        """
+        Streams {"results":[...],"filters":..,"extdata":..} without holding the whole list in memory.
+        Rows are serialized in chunks of stream_chunk_size from the queryset iterator and the related
+        views are fetched once the rows are sent, their data following results as top level members.
+        get_final_response of such views does not get the results in response data.
+        prefetch_related lookups are applied per chunk, as iterator() ignores them before django 4.1
+        and requires a chunk_size for them since 5.0. An error once the response started is logged and
+        closes the document with an "error" member holding stream_error_message.
+        """
+        response=self.addAppliedFilters(Response({}))
+        def content():
+            closed = False
+            yield '{"results":['
+            try:
+                separator = ''
+                mapping = self.get_values_mapping(queryset)
+                rows = self.get_values_queryset(queryset,mapping) if mapping else queryset
+                lookups = getattr(rows,'_prefetch_related_lookups',None)
+                if lookups:
+                    rows = rows.prefetch_related(None)
+                rows = rows.iterator() if hasattr(rows,'iterator') else iter(rows)
+                while True:
+                    chunk = list(islice(rows,self.stream_chunk_size))
+                    if not chunk:
+                        break
+                    if lookups:
+                        prefetch_related_objects(chunk,*lookups)
+                    data = mapping.map_rows(chunk) if mapping else self.get_serializer(chunk,many=True).data
+                    yield separator+self.stream_encode(data)[1:-1]
+                    separator = ','
+                yield ']'
+                closed = True
+                #the body is iterated after the view returned, so related views are not deferred to as_async_view
+                self.deferred_related = False
+                data = self.fetch_related(request,response,*args,**kwargs).data
+                for key,value in data.items():
+                    if key!='results':
+                        yield ',%s:%s' %(self.stream_encode(key),self.stream_encode(value))
+            except Exception:
+                #the status is already sent, the document is closed with an error member instead
+                logger.exception('Streamed list of %s failed',self.__class__.__name__)
+                yield '%s,"error":%s' %('' if closed else ']',self.stream_encode(self.stream_error_message))
+            yield '}'
+        return StreamingHttpResponse(content(),content_type='application/json')
+
+    def stream_encode(self,data):
+        return json.dumps(data,cls=encoders.JSONEncoder,ensure_ascii=False,separators=(',',':'))
+
     def addAppliedFilters(self,response):
         """
         Add the filters applied to the view to response using the view applied_filters attribute accessible with filters key
@@ -46,8 +197,34 @@ class ListAPIView(generics.ListAPIView,RelatedView):
         Overridden generics.ListAPIView filter_queryset method for adding the filters applied to this view.
         Appends filters applied to ListAPIView instance as applied_filters attribute.
         It fetches the filter from filter_backends by calling its get_applied_filters method.
+        With pk_cache_duration set the filtered primary keys are cached, see cache_pks.
+        Relations inferred from the serializer are applied at the end, see InferRelatedMixin.
         """
+        cache_key = self.get_pk_cache_key()
+        cached = cache.get(cache_key) if cache_key else None
+        if cached is not None and cached[0] is not None:
+            #filter backends are skipped, their outcome is in the cache
+            pks,self.applied_filters,nopagination = cached
+            if nopagination:
+                self.pagination_class = NoPagination
+            queryset = CachedPkList(queryset,pks)
+        else:
+            base_queryset = queryset
+            queryset = self.apply_filter_backends(queryset)
+            #a cached entry here marks too many primary keys to cache
+            if cache_key and cached is None:
+                queryset = self.cache_pks(cache_key,base_queryset,queryset)
+        if isinstance(queryset,CachedPkList):
+            queryset.queryset = self.apply_inferred_relations(queryset.queryset)
+        else:
+            queryset = self.apply_inferred_relations(queryset)
+        #rows fetched together with other related views by the RelatedLoader of the main view
+        preloaded = getattr(self.request,'preloaded_queryset',None)
+        if preloaded is not None:
+            return preloaded
+        return queryset
 
+    def apply_filter_backends(self,queryset):
         filters = {}
         for backend in list(self.filter_backends):
             backendobj = backend()
@@ -56,21 +233,97 @@ class ListAPIView(generics.ListAPIView,RelatedView):
                 filters.update(backendobj.get_applied_filters())
         self.applied_filters = OrderedDict()
         from datetime import datetime, date
-        for key,value in filters.items():
+        for key,value in list(filters.items()):
             if isinstance(value,(datetime,date)):
                 self.applied_filters[key]=value
                 del filters[key]
         self.applied_filters.update(sorted(filters.items(),key=itemgetter(1),reverse=True))
         return queryset
 
+    def get_pk_cache_key(self):
+        """
+        Key of the cached primary keys when pk_cache_duration is set. It is made of the view,
+        the versions of pk_cache_models and the request parameters except the pagination ones.
+        Override it when get_queryset varies per user. None when the pagination needs the queryset
+        itself (requires_queryset attribute, e.g KeysetPagination) rather than a list of rows.
+        """
+        if not self.pk_cache_duration or getattr(self.pagination_class,'requires_queryset',False):
+            return None
+        cls = self.__class__
+        #not self.paginator, which would keep the pagination before CountBackend switches it
+        excluded = set(['format'])
+        for attr in ('page_query_param','page_size_query_param','cursor_query_param'):
+            if getattr(self.pagination_class,attr,None):
+                excluded.add(getattr(self.pagination_class,attr))
+        query_params = self.request.query_params
+        if isinstance(query_params,QueryDict):
+            params = [(key,','.join(values)) for key,values in query_params.lists()]
+        else:
+            params = [(key,cache_value(value)) for key,value in query_params.items()]
+        params += [(key,cache_value(value)) for key,value in self.kwargs.items()]
+        params = sorted((key,value) for key,value in params if key not in excluded)
+        versions = get_model_versions([model_label(model) for model in self.pk_cache_models])
+        key = '%s.%s:%s:%s' %(cls.__module__,cls.__name__,urlencode(params),versions)
+        return 'pks:%s' %hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def cache_pks(self,cache_key,base_queryset,queryset):
+        """
+        Caches the ordered primary keys of the filtered queryset along with applied_filters,
+        unless there are more than pk_cache_max_size of them. Pages are then fetched with pk__in.
+        More primary keys than that are marked in the cache so that they are not read again.
+        """
+        if hasattr(queryset,'values_list'):
+            pks = list(queryset.values_list('pk',flat=True)[:self.pk_cache_max_size+1])
+        else:
+            pks = [row.pk for row in queryset[:self.pk_cache_max_size+1]]
+        if len(pks)>self.pk_cache_max_size:
+            cache.set(cache_key,(None,None,None),self.pk_cache_duration)
+            return queryset
+        nopagination = self.pagination_class is NoPagination
+        cache.set(cache_key,(pks,self.applied_filters,nopagination),self.pk_cache_duration)
+        return CachedPkList(base_queryset,pks)
+
+    @classmethod
+    def get_batch_queryset(cls,request,initkwargs,kwargs):
+        """
+        filtered queryset of this view when called as related view with request and kwargs,
+        used by RelatedLoader for views declaring batch_field. It is not evaluated here.
+        """
+        self = cls(**initkwargs)
+        self.retType = 'data'
+        self.request = request
+        self.format_kwarg = None
+        self.args = ()
+        self.kwargs = kwargs
+        return self.filter_queryset(self.get_queryset())
+
+
+class RetrieveAPIView(InferRelatedMixin,generics.RetrieveAPIView,RelatedView):
+
+    def initial(self,request,*args,**kwargs):
+        self.start_main_metrics()
+        super(RetrieveAPIView,self).initial(request,*args,**kwargs)
 
-class RetrieveAPIView(generics.RetrieveAPIView,RelatedView):
+    def finalize_response(self,request,response,*args,**kwargs):
+        #detaches the query tracker when fetch_related was not reached (denied, 404, 304, errors)
+        self.stop_main_metrics()
+        return super(RetrieveAPIView,self).finalize_response(request,response,*args,**kwargs)
+
+    def filter_queryset(self,queryset):
+        queryset = super(RetrieveAPIView,self).filter_queryset(queryset)
+        return self.apply_inferred_relations(queryset)
 
     def retrieve(self,request,*args,**kwargs):
         """ 
         Overridden generics.RetrieveAPIView retrieve method to provide additional 
         functionality of related views data fetching
         """
+        not_modified = self.check_not_modified(request)
+        if not_modified is not None:
+            return not_modified
+        cached = self.get_cached_page(request,*args,**kwargs)
+        if cached is not None:
+            return cached
         response=super(RetrieveAPIView,self).retrieve(request,*args,**kwargs)
         return self.fetch_related(request,response,*args,**kwargs)
 
@@ -80,7 +333,22 @@ class APIView(GAPIView,RelatedView):
 
     """
     template_name = None
+    def initial(self,request,*args,**kwargs):
+        self.start_main_metrics()
+        super(APIView,self).initial(request,*args,**kwargs)
+
+    def finalize_response(self,request,response,*args,**kwargs):
+        #detaches the query tracker when fetch_related was not reached (denied, 404, 304, errors)
+        self.stop_main_metrics()
+        return super(APIView,self).finalize_response(request,response,*args,**kwargs)
+
     def get(self,request,*args,**kwargs):
+        not_modified = self.check_not_modified(request)
+        if not_modified is not None:
+            return not_modified
+        cached = self.get_cached_page(request,*args,**kwargs)
+        if cached is not None:
+            return cached
         response = Response({})
         return self.fetch_related(request,response,*args,**kwargs)
 
@@ -136,6 +404,31 @@ class TabAPIView(RelatedView):
         return super(TabAPIView,self).get_requested_views(request,returnformat)
                     
 class FormView(APIView,RelatedView):
+    """
+    Multi step form flow. Its state (flow, packet and form view caches) lives in a request scoped
+    store written once per request in finalize_response (finalize_data when called through as_data),
+    see flow.SessionFlowStore and CacheFlowStore.
+    """
+    flow_store_class = None
+
+    def get_flow_store(self):
+        if getattr(self,'_flow_store',None) is None:
+            self._flow_store = get_flow_store_class(self)(self.request)
+        return self._flow_store
+
+    def save_flow_store(self):
+        if getattr(self,'_flow_store',None) is not None:
+            self._flow_store.save()
+
+    def finalize_response(self,request,response,*args,**kwargs):
+        self.save_flow_store()
+        return super(FormView,self).finalize_response(request,response,*args,**kwargs)
+
+    def finalize_data(self,request):
+        #called as related view, finalize_response is not reached
+        self.save_flow_store()
+        super(FormView,self).finalize_data(request)
+
     def get(self,request,*args,**kwargs):
         self.processRequest(request,*args,**kwargs)
         self.is_get_call=True
@@ -165,6 +458,8 @@ class FormView(APIView,RelatedView):
         if flow:
             if len(flow)>0:
                 last_flow =flow[-1] if not pop else flow.pop()
+                if pop:
+                    self.get_flow_store().set_flow(flow)
             if len(flow)==0:
                 self._destroy_flow(self.request)
         return last_flow
@@ -219,7 +514,7 @@ class FormView(APIView,RelatedView):
             url = reverse('homepage')
         if packet and isinstance(packet,dict):
             packet['to']=view_url
-            self.request.session['_packet']=packet
+            self.get_flow_store().set_packet(packet)
 
         if finalurl:
             self._initiate_flow(self.request,finalurl) 
@@ -243,7 +538,7 @@ class FormView(APIView,RelatedView):
                 query_dict.update({'_caller':self.view_url_name})
                 if packet and isinstance(packet,dict):
                     packet['to']=self._get_urlname(redirect_url)
-                    self.request.session['_packet']=packet
+                    self.get_flow_store().set_packet(packet)
             redirect_url = self.get_query_url(redirect_url,query_dict)
             return self.redirect_to(redirect_url,data)
         return self.redirect_to(reverse('homepage'),data)
@@ -272,7 +567,7 @@ class FormView(APIView,RelatedView):
             self._sessdata.pop(key,None)
         else:
             self._sessdata[key]=data
-        self.request.session[self.view_url_name]=self._sessdata
+        self.get_flow_store().set_view_data(self.view_url_name,self._sessdata)
         return True
 
     def set_form_data(self,data):
@@ -289,38 +584,29 @@ class FormView(APIView,RelatedView):
     def get_packet(self):
         return self._packet
     def get_flow(self):
-        return self.request.session.get('_formflow',None)
+        return self.get_flow_store().get_flow()
 
     def _addurl(self,url):
-        formflow = self.request.session.get('_formflow',[])
+        store = self.get_flow_store()
+        formflow = store.get_flow() or []
         #@TODO Remove it from here
         if not formflow:
             self._initiate_flow(self.request,withurl='/')
-            formflow = self.request.session.get('_formflow',[])
+            formflow = store.get_flow() or []
             #raise Exception('_addurl called before initiating the flow')
         formflow.append({'by':self.view_url_name,'url':url})
-        self.request.session['_formflow']=formflow
+        store.set_flow(formflow)
         return True
 
     def _destroy_flow(self,request):
-        sess=request.session
-        keys = request.session.keys()
-        #@TODO check if these deletions are making multiple db hits
-        if '_packet' in keys:
-            del sess['_packet']
-        if '_formflow' in keys:
-            del sess['_formflow']
-        for key in keys:
-            if key.endswith('_form_view'):
-                del sess[key]
-
+        #flow, packet and every form view cache go at once
+        self.get_flow_store().clear()
 
     def _initiate_flow(self,request,withurl=None):
         self._destroy_flow(request)
-        sess=request.session
         if not withurl:
             withurl = settings.LOGIN_REDIRECT_URL
-        sess['_formflow']=[{'by':'initiator','url':withurl}]
+        self.get_flow_store().set_flow([{'by':'initiator','url':withurl}])
         return True
     def _get_current_url(self):
         return reverse(self.view_url_name)
@@ -332,12 +618,12 @@ class FormView(APIView,RelatedView):
         caller = request.query_params.get('_caller',False)
         #check if called from another view
         if caller:
-            packet = request.session.get('_packet',{})
+            packet = self.get_flow_store().get_packet() or {}
             #@TODO what to do if packet is not found
             # Is this invalid packet?
             if packet.get('to',None) == keyname:
                 self._packet = packet
-                request.session.pop('_packet',None)
+                self.get_flow_store().set_packet(None)
             self._caller = caller
         else:
             url_name,referer = self._get_current_referer(request)
@@ -354,7 +640,7 @@ class FormView(APIView,RelatedView):
                 else:
                     self._initiate_flow(request,withurl=referer)
                     #it means urls in session are valid
-        self._sessdata = request.session.get(keyname,{})
+        self._sessdata = self.get_flow_store().get_view_data(keyname) or {}
 
     def call_get(self,request,*args,**kwargs):
         if is_ajax(request):
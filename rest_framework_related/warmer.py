@@ -0,0 +1,91 @@
+import logging
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+from django.test import RequestFactory
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+from rest_framework.request import Request
+from rest_framework.renderers import TemplateHTMLRenderer
+
+from .utility import _memoized_registry
+from .py2_3 import *
+
+logger = logging.getLogger(__name__)
+
+def load_views():
+    """ imports the url configuration, which creates the memoized views of related_views """
+    try:
+        from django.urls import get_resolver
+    except ImportError:
+        # django < 1.10
+        from django.core.urlresolvers import get_resolver
+    get_resolver().url_patterns
+
+def get_warm_host():
+    """
+    host of the warm request, RELATED_VIEWS_WARM_HOST setting or the first ALLOWED_HOSTS entry
+    which is not a wildcard, so that request.get_host does not raise DisallowedHost
+    """
+    host = getattr(settings,'RELATED_VIEWS_WARM_HOST',None)
+    if host:
+        return host
+    for allowed in getattr(settings,'ALLOWED_HOSTS',None) or ():
+        if allowed!='*':
+            return allowed.lstrip('.')
+    return 'localhost'
+
+def get_warm_request(path='/',host=None):
+    """ anonymous request the views are replayed with, rendered as html so that memoization applies """
+    host = host or get_warm_host()
+    request = Request(RequestFactory().get(path,HTTP_HOST=host,SERVER_NAME=host.rsplit(':',1)[0]))
+    request.accepted_renderer = TemplateHTMLRenderer()
+    request.accepted_media_type = TemplateHTMLRenderer.media_type
+    return request
+
+def _warm(memoized,request,params):
+    try:
+        return memoized.warm(request,params)
+    except Exception:
+        logger.warning('Warming %s with %s failed',memoized.name,params,exc_info=True)
+        return False
+    finally:
+        connections.close_all()
+
+def warm_memoized(top=100,max_workers=4,names=None,request=None,host=None):
+    """
+    Refills the cache of memoized views recording their calls (cache_warm_sample) by replaying the
+    top most frequent parameter combinations of each through as_data, on max_workers threads.
+    names limits it to views whose name (module.Class:initkwargs) starts with one of them.
+    Data still fresh is left as it is. Returns {name:(replayed,computed)}.
+    host is the one of the replayed request, see get_warm_host.
+    """
+    load_views()
+    request = request or get_warm_request(host=host)
+    tasks = []
+    for name,memoized in list(_memoized_registry.items()):
+        if memoized.access_log is None or (names and not any(name.startswith(each) for each in names)):
+            continue
+        memoized.access_log.flush()
+        for params in memoized.access_log.top(top):
+            tasks.append((memoized,params))
+    if ThreadPoolExecutor is None or max_workers<=1:
+        results = [_warm(memoized,request,params) for memoized,params in tasks]
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            results = list(executor.map(lambda task:_warm(task[0],request,task[1]),tasks))
+        finally:
+            executor.shutdown(wait=True)
+    report = OrderedDict()
+    for (memoized,params),computed in zip(tasks,results):
+        replayed,total = report.get(memoized.name,(0,0))
+        report[memoized.name] = (replayed+1,total+int(bool(computed)))
+    return report
@@ -2,7 +2,7 @@ from setuptools import setup
 
 setup(
   name = 'drf-related-views',
-  packages = ['rest_framework_related'],
+  packages = ['rest_framework_related','rest_framework_related.management','rest_framework_related.management.commands'],
   version = '0.0.5',
   description = 'Related Views for Django Rest Framework',
   author = 'Fasih Ahmad Fakhri',